@@ -1,187 +1,224 @@
 # Requirements: pandas, numpy
-import pandas as pd
-import numpy as np
+import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
 
-# 1. Load CSVs
-vessel = pd.read_csv("M:/NEW-PROJECT/AUTOMORPH/vessel_features_merged.csv", low_memory=False)
-pat = pd.read_csv("M:/NEW-PROJECT/AUTOMORPH/retina_ckd_survival_ready_PAIRED.csv", low_memory=False)
+from cv_folds import DEFAULT_FOLDS, FOLDS_TABLE, fold_index, fold_sizes
+from eid_index import load_eid_index
+from incremental import delta_config, delta_summary, load_state, pivot_delta, resolve_delta, save_state
+from ingest import DEFAULT_CHUNKSIZE, read_participants, stream_vessel
+from pipeline import write_qc_report
+from qc_pipeline import (aggregated_table, build_participant, eye_blocks, feature_columns, image_stats,
+                         normalize_participants, qc_counts, resolve_images)
+from sharded import build_participant_sharded, eye_blocks_sharded, resolve_images_sharded, shard_pool
+from stage_profiler import METRICS_NAME, StageProfiler
+from table_io import (AGGREGATED_TABLE, COMPRESSIONS, DEFAULT_IO_THREADS, EYE_USED_TABLE, FORMATS, IMAGE_TABLE,
+                      PARTICIPANT_TABLE, atomic_output, csv_compression, format_write_log, remove_stale_copies, table_path,
+                      write_table)
+
+VESSEL_FP = "M:/NEW-PROJECT/AUTOMORPH/vessel_features_merged.csv"
+PAT_FP = "M:/NEW-PROJECT/AUTOMORPH/retina_ckd_survival_ready_PAIRED.csv"
 # Output directory (change here if you want outputs elsewhere)
 OUTPUT_DIR = r"M:/NEW-PROJECT/AUTOMORPH"
-
-# 2. Normalize filenames: extract basename, strip whitespace and lower
-def norm_fname(x):
-    if pd.isna(x): 
-        return np.nan
-    x = str(x).strip()
-    x = os.path.basename(x)   # removes any path
-    x = x.lower()
-    return x
-
-vessel["orig_fname_norm"] = vessel["original_filename"].apply(norm_fname)
-
-# If vessel has file extension variations or extra suffixes, you can optionally remove extensions:
-vessel["orig_fname_stem"] = vessel["orig_fname_norm"].str.replace(r'\.[a-z0-9]+$', '', regex=True)
-
-pat["left_fname_norm"] = pat["left_image_filename"].apply(norm_fname)
-pat["left_fname_stem"] = pat["left_fname_norm"].str.replace(r'\.[a-z0-9]+$', '', regex=True)
-pat["right_fname_norm"] = pat["right_image_filename"].apply(norm_fname)
-pat["right_fname_stem"] = pat["right_fname_norm"].str.replace(r'\.[a-z0-9]+$', '', regex=True)
-
-# 3. Image-level merge: attach eid to vessel rows by matching on filename stem first, then full name as fallback
-
-# Create mapping table: filename stem -> set of eids (in case duplicates exist)
-left_map = pat[["eid", "left_fname_norm", "left_fname_stem"]].dropna(subset=["left_fname_stem"]).rename(
-    columns={"left_fname_stem": "fname_stem", "left_fname_norm": "fname_norm"})
-right_map = pat[["eid", "right_fname_norm", "right_fname_stem"]].dropna(subset=["right_fname_stem"]).rename(
-    columns={"right_fname_stem": "fname_stem", "right_fname_norm": "fname_norm"})
-maps = pd.concat([left_map, right_map], ignore_index=True)
-maps = maps.drop_duplicates(subset=["eid", "fname_stem", "fname_norm"])
-
-# If multiple eids map to same filename, we'll flag it for QC
-fname_to_eids = maps.groupby("fname_stem")["eid"].unique().to_dict()
-
-def map_eid_by_stem(stem):
-    if pd.isna(stem):
-        return np.nan
-    eids = fname_to_eids.get(stem)
-    if isinstance(eids, (list, np.ndarray)) and len(eids) == 1:
-        return eids[0]
-    # ambiguous or not found
-    return np.nan
-
-vessel["matched_eid_stem"] = vessel["orig_fname_stem"].apply(map_eid_by_stem)
-
-# For those unmatched by stem, try matching by full normalized filename
-fname_norm_to_eids = maps.groupby("fname_norm")["eid"].unique().to_dict()
-
-def map_eid_by_full_norm(fname):
-    if pd.isna(fname):
-        return np.nan
-    eids = fname_norm_to_eids.get(fname)
-    if isinstance(eids, (list, np.ndarray)) and len(eids) == 1:
-        return eids[0]
-    return np.nan
-
-vessel["matched_eid_full"] = vessel["orig_fname_norm"].apply(map_eid_by_full_norm)
-
-# Prefer stem match then full match
-vessel["eid"] = vessel["matched_eid_stem"].combine_first(vessel["matched_eid_full"])
-
-# Keep track of mapping status
-def mapping_status(row):
-    if not pd.isna(row["matched_eid_stem"]): return "stem_matched"
-    if not pd.isna(row["matched_eid_full"]): return "full_matched"
-    return "unmatched"
-
-vessel["mapping_status"] = vessel.apply(mapping_status, axis=1)
-
-# 4. Save image-level master
-vessel.to_csv(os.path.join(OUTPUT_DIR, "master_image_level.csv"), index=False)
-
-# 5. Participant-level left/right pivot: join vessel features into participant table
-
-# Prepare vessel features: select numeric feature columns only (exclude mapping/meta columns)
-exclude = {"original_filename", "orig_fname_norm", "orig_fname_stem", "matched_eid_stem", "matched_eid_full", "eid", "mapping_status"}
-# Prefer numeric columns only to avoid aggregation errors on string columns
-numeric_cols = vessel.select_dtypes(include=[np.number]).columns.tolist()
-feature_cols = [c for c in numeric_cols if c not in exclude]
-
-# Split vessel into left/right by matching to participants using left/right normalized filename
-# Merge left features
-left = vessel.merge(pat[["eid", "left_fname_stem"]], left_on="orig_fname_stem", right_on="left_fname_stem", how="inner", suffixes=("","_pat"))
-left = left.rename(columns={c: f"left_{c}" for c in feature_cols if c in left.columns})
-# Keep only eid and left_* features
-left_cols_keep = ["eid"] + [c for c in left.columns if c.startswith("left_")]
-left = left[left_cols_keep].drop_duplicates(subset=["eid"])
-
-# Also merge right-eye features so we can build a combined single-image per participant (left preferred, otherwise right)
-right = vessel.merge(pat[["eid", "right_fname_stem"]], left_on="orig_fname_stem", right_on="right_fname_stem", how="inner", suffixes=("","_pat"))
-right = right.rename(columns={c: f"right_{c}" for c in feature_cols if c in right.columns})
-# Keep only eid and right_* features
-right_cols_keep = ["eid"] + [c for c in right.columns if c.startswith("right_")]
-right = right[right_cols_keep].drop_duplicates(subset=["eid"])
-
-# Combine left/right into participant table
-participant = pat.copy()
-participant = participant.merge(left, on="eid", how="left")
-participant = participant.merge(right, on="eid", how="left")
-
-# 6. QC flags and aggregations
-# Coerce any left_/right_ merged columns to numeric (invalid parsing -> NaN) before aggregation
-for c in participant.columns:
-    if c.startswith("left_") or c.startswith("right_"):
-        participant[c] = pd.to_numeric(participant[c], errors='coerce')
-
-participant["has_left_features"] = participant[[c for c in participant.columns if c.startswith("left_")]].notna().any(axis=1)
-participant["has_right_features"] = participant[[c for c in participant.columns if c.startswith("right_")]].notna().any(axis=1)
-participant["num_images_with_features"] = participant[["has_left_features","has_right_features"]].sum(axis=1)
-# number of images with left-eye features specifically (useful for QC/selection)
-participant["num_images_with_left_eye_features"] = participant["has_left_features"].astype(int)
-
-# Build combined single-image features: prefer left if present, otherwise use right. Record which eye was used.
-# initialize as object dtype to avoid dtype issues when assigning string labels
-participant["eye_used"] = pd.Series([None] * len(participant), dtype=object)
-for f in feature_cols:
-    left_col = f"left_{f}"
-    right_col = f"right_{f}"
-    # create combined base feature name (overwrite if exists)
-    if left_col in participant.columns or right_col in participant.columns:
-        # where left present use left, else use right
-        vals = None
-        if left_col in participant.columns and right_col in participant.columns:
-            vals = participant[left_col].combine_first(participant[right_col])
-        elif left_col in participant.columns:
-            vals = participant[left_col]
+# Eye selection for the combined single-image features: left_first, right_first, mean or best_quality
+EYE_POLICY = "left_first"
+# Optional image-level quality column used by best_quality (default: number of non-missing features)
+QUALITY_COL = None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build image- and participant-level master tables and a QC report.")
+    ap.add_argument("--stream", action="store_true",
+                    help="read vessel_features_merged.csv in chunks with a compact float32 schema (bounded memory)")
+    ap.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE, help="rows per chunk in --stream mode")
+    ap.add_argument("--formats", nargs="+", choices=FORMATS, default=["csv"],
+                    help="output formats for the master tables; parquet/feather participant tables are partitioned by eye_used")
+    ap.add_argument("--compress", choices=COMPRESSIONS, default=None,
+                    help="compress the CSV outputs while writing (.csv.gz / .csv.zst; zstd needs zstandard)")
+    ap.add_argument("--io-threads", type=int, default=DEFAULT_IO_THREADS,
+                    help="threads that read the inputs and write the output tables concurrently")
+    ap.add_argument("--profile", action="store_true",
+                    help="record per-stage wall time, RSS, row counts and mapping-status breakdown in pipeline_metrics.json")
+    ap.add_argument("--incremental", action="store_true",
+                    help="reuse the previous run's state in the output directory: only new/changed image rows are resolved "
+                         "and only their participants re-pivoted and rewritten (byte-identical to a full rebuild)")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="processes for normalization, eid resolution, pivot and eye selection (participants sharded by eid)")
+    ap.add_argument("--ukb-filenames", action="store_true",
+                    help="take eid/eye straight from UK Biobank names (<eid>_21015|21016_<instance>_<array>), join only the rest; "
+                         "per participant and eye the earliest instance is used")
+    ap.add_argument("--cv-folds", type=int, default=DEFAULT_FOLDS,
+                    help="participant-grouped cross-validation folds written to master_cv_folds (0 = none)")
+    ap.add_argument("--cv-seed", type=int, default=0, help="seed of the eid hash that assigns the folds")
+    ap.add_argument("--cv-stratify", nargs="+", default=[], metavar="COL",
+                    help="participant columns to stratify the folds by, e.g. eye_used or outcome columns")
+    args = ap.parse_args()
+    if args.incremental and args.stream:
+        ap.error("--incremental works on the in-memory pipeline; drop --stream")
+    if args.incremental and args.compress:
+        ap.error("--incremental patches the uncompressed CSVs; drop --compress")
+    try:
+        csv_compression(args.compress)
+    except ImportError as e:
+        ap.error(str(e))
+    if args.workers > 1 and (args.stream or args.incremental):
+        ap.error("--workers runs the full in-memory pipeline; drop --stream/--incremental")
+    if args.ukb_filenames and (args.stream or args.incremental or args.workers > 1):
+        ap.error("--ukb-filenames runs on the serial in-memory pipeline; drop --stream/--incremental/--workers")
+    if args.cv_folds == 1 or args.cv_folds < 0:
+        ap.error("--cv-folds must be 0 (no fold index) or at least 2")
+
+    # Optional per-stage metrics (wall time, RSS, rows in/out, mapping-status breakdown) -> pipeline_metrics.json
+    prof = StageProfiler(enabled=args.profile)
+
+    # I/O threads: the vessel CSV is read while the participant side is prepared, and every output table is
+    # written in the background (to a .tmp name, renamed when complete); write_log gets bytes/seconds per file
+    io_pool = ThreadPoolExecutor(max_workers=max(1, args.io_threads))
+    vessel_future = None if args.stream else io_pool.submit(pd.read_csv, VESSEL_FP, low_memory=False)
+    writes, write_log = [], []
+
+    # 1. Load participant CSV and the filename -> eid index
+    # (index cached next to the participant CSV, rebuilt when that file changes)
+    with prof.stage("load_participants") as st:
+        pat = read_participants(PAT_FP) if args.stream else pd.read_csv(PAT_FP, low_memory=False)
+        eid_index = load_eid_index(PAT_FP)
+        st["rows_out"] = len(pat)
+    # Worker processes for --workers N (each receives the index once)
+    pool = shard_pool(args.workers, eid_index) if args.workers > 1 else None
+
+    # 2. Normalize filenames: extract basename, strip whitespace and lower (vectorized, see fname_norm.py)
+    with prof.stage("normalize_participants", rows_in=len(pat)) as st:
+        normalize_participants(pat)
+        st["rows_out"] = len(pat)
+
+    if args.stream:
+        # 3.-5. Stream image rows: normalize, resolve and save each chunk, folding it into the left/right blocks
+        # (the image-level master is appended chunk by chunk, so it is always written as CSV in this mode)
+        with prof.stage("stream_images") as st:
+            image_fp = table_path(OUTPUT_DIR, IMAGE_TABLE, "csv", args.compress)
+            with atomic_output(image_fp) as tmp_fp:
+                left_block, right_block, feature_cols, stats = stream_vessel(
+                    VESSEL_FP, pat, eid_index, chunksize=args.chunksize, image_out_fp=tmp_fp, compression=args.compress)
+            remove_stale_copies(OUTPUT_DIR, IMAGE_TABLE, ["csv"], args.compress)
+            st["rows_in"], st["rows_out"] = stats["n_vessel_rows"], len(left_block)
+        participant_reuse = None
+    else:
+        with prof.stage("load_images") as st:
+            # (only the wait for the background read is timed here)
+            vessel = vessel_future.result()
+            st["rows_out"] = len(vessel)
+
+        # 3. Image-level merge: attach eid to vessel rows by matching on filename stem first, then full name as fallback.
+        # One join-based pass gives eid, eye side, mapping status (stem_matched/full_matched/unmatched)
+        # and the number of candidate eids per image; filenames listed for several eids stay unmatched.
+        # In --incremental mode rows already in the previous run's manifest keep their resolution
+        # (see incremental.py); delta["image_reuse"] maps them to their lines in the previous image CSV
+        # With --workers N the image rows are resolved in N processes (see sharded.py)
+        # With --ukb-filenames eid/eye/instance are parsed from UK Biobank names and only the other rows are joined
+        with prof.stage("resolve_images", rows_in=len(vessel)) as st:
+            if args.incremental:
+                config = delta_config(PAT_FP, EYE_POLICY, QUALITY_COL, args.formats)
+                vessel, delta = resolve_delta(vessel, eid_index, load_state(OUTPUT_DIR, config), config)
+            elif pool is not None:
+                vessel, stats = resolve_images_sharded(pool, vessel, eid_index, args.workers)
+            else:
+                vessel = resolve_images(vessel, eid_index, parse_ukb=args.ukb_filenames)
+            st["rows_out"] = len(vessel)
+
+        # 4. Save image-level master (in the background while the participant tables are built)
+        writes.append(io_pool.submit(write_table, vessel, OUTPUT_DIR, IMAGE_TABLE, args.formats,
+                                     reuse=delta["image_reuse"] if args.incremental else None,
+                                     compression=args.compress, log=write_log))
+
+        # 5. Participant-level left/right pivot: numeric feature columns only (mapping/meta columns excluded),
+        # split on the eye side found during eid resolution and aligned to the participant rows
+        with prof.stage("pivot", rows_in=len(vessel)) as st:
+            feature_cols = feature_columns(vessel)
+            participant_reuse = None
+            if args.incremental:
+                # only participants whose image rows changed are re-pivoted
+                left_block, right_block, participant_reuse = pivot_delta(vessel, feature_cols, pat["eid"], delta)
+            elif pool is not None:
+                # participants and their image rows hash-partitioned by eid (stats were merged from the shards)
+                left_block, right_block = eye_blocks_sharded(pool, vessel, feature_cols, pat["eid"], args.workers)
+            else:
+                left_block, right_block = eye_blocks(vessel, feature_cols, pat["eid"])
+            if pool is None:
+                stats = image_stats(vessel)
+            st["rows_out"] = len(left_block)
+
+    # 6. QC flags and eye selection (2-D operations over the aligned left/right blocks)
+    with prof.stage("eye_selection", rows_in=len(pat)) as st:
+        if pool is not None:
+            participant = build_participant_sharded(pool, pat, left_block, right_block, feature_cols, EYE_POLICY,
+                                                    QUALITY_COL, n_shards=args.workers)
+            pool.shutdown()
         else:
-            vals = participant[right_col]
-        participant[f] = vals
-
-# Determine eye_used: left if any left feature present, else right if any right feature present
-participant.loc[participant[ [c for c in participant.columns if c.startswith('left_')] ].notna().any(axis=1), 'eye_used'] = 'left'
-participant.loc[(participant['eye_used'].isna()) & (participant[ [c for c in participant.columns if c.startswith('right_')] ].notna().any(axis=1)), 'eye_used'] = 'right'
-
-# Also create simple flags for QC
-participant['used_left'] = participant['eye_used'] == 'left'
-participant['used_right'] = participant['eye_used'] == 'right'
-
-
-# 7. Basic QC report counts
-qc = {}
-qc["n_vessel_rows"] = len(vessel)
-qc["n_unique_image_filenames_in_vessel"] = vessel["orig_fname_stem"].nunique()
-qc["n_pat_rows"] = len(pat)
-qc["n_left_fnames_nonmissing"] = pat["left_fname_stem"].notna().sum()
-# Right-eye counts removed intentionally; pipeline uses left eye only
-qc["n_images_mapped_to_eid"] = vessel["eid"].notna().sum()
-qc["n_unique_eids_mapped_from_images"] = vessel["eid"].dropna().nunique()
-qc["n_participants_with_left_eye_features"] = participant["has_left_features"].sum()
-qc["n_participants_with_right_eye_features"] = participant["has_right_features"].sum()
-qc["n_participants_used_left"] = participant['used_left'].sum()
-qc["n_participants_used_right"] = participant['used_right'].sum()
-
-with open("qc_report.txt", "w") as fh:
-    for k,v in qc.items():
-        fh.write(f"{k}: {v}\n")
-
-# 8. Save participant-level outputs (single-image per participant: left eye only)
-participant.to_csv(os.path.join(OUTPUT_DIR, "master_participant_level_single_image.csv"), index=False)
-
-# Save aggregated participant summary (select only eid, key covariates, and aggregated features)
-# Also provide aggregated participant summary with base feature names (no suffix) so downstream expects one image per participant
-# Copy left-prefixed feature columns into base feature names (overwrite if present)
-for f in feature_cols:
-    left_col = f"left_{f}"
-    if left_col in participant.columns:
-        participant[f] = participant[left_col]
-
-agg_cols = ["eid", "num_images_with_left_eye_features", "has_left_features"]
-agg_cols += [f for f in feature_cols if f in participant.columns]
-participant[agg_cols].to_csv(os.path.join(OUTPUT_DIR, "master_participant_level_single_image_aggregated.csv"), index=False)
-
-# Also save a file indicating which eye was used per participant
-participant[['eid','eye_used']].to_csv(os.path.join(OUTPUT_DIR, 'master_participant_eye_used.csv'), index=False)
-
-# 9. Print a brief summary to console
-print(f"Saved: {os.path.join(OUTPUT_DIR, 'master_image_level.csv')}, {os.path.join(OUTPUT_DIR, 'master_participant_level_single_image.csv')}, {os.path.join(OUTPUT_DIR, 'master_participant_level_single_image_aggregated.csv')}, {os.path.join(OUTPUT_DIR, 'master_participant_eye_used.csv')}, {os.path.join(OUTPUT_DIR, 'qc_report.txt')}")
-print(qc)
+            participant = build_participant(pat, left_block, right_block, feature_cols, EYE_POLICY, QUALITY_COL)
+        st["rows_out"] = len(participant)
+
+    # 7. Basic QC report counts
+    with prof.stage("qc", rows_in=len(participant)) as st:
+        qc = qc_counts(stats, pat, participant)
+
+    qc_fp = write_qc_report(qc, OUTPUT_DIR)
+
+    # 8. Save participant-level outputs (single-image per participant: left eye only)
+    # (--incremental: only the lines of re-pivoted participants are re-formatted in the CSVs)
+    write_kw = dict(partition=participant["eye_used"], reuse=participant_reuse, compression=args.compress, log=write_log)
+    writes.append(io_pool.submit(write_table, participant, OUTPUT_DIR, PARTICIPANT_TABLE, args.formats, **write_kw))
+
+    # Save aggregated participant summary (select only eid, key covariates, and aggregated features)
+    # Also provide aggregated participant summary with base feature names (no suffix) so downstream expects one image per participant
+    writes.append(io_pool.submit(write_table, aggregated_table(participant, left_block, feature_cols), OUTPUT_DIR,
+                                 AGGREGATED_TABLE, args.formats, **write_kw))
+
+    # Also save a file indicating which eye was used per participant
+    writes.append(io_pool.submit(write_table, participant[['eid','eye_used']], OUTPUT_DIR, EYE_USED_TABLE, args.formats,
+                                 **write_kw))
+
+    # 9. Participant-grouped CV fold index with row offsets into the combined / left-only / right-only views
+    folds = None
+    if args.cv_folds:
+        with prof.stage("cv_folds", rows_in=len(participant)) as st:
+            folds = fold_index(participant, args.cv_folds, args.cv_seed, args.cv_stratify)
+            writes.append(io_pool.submit(write_table, folds, OUTPUT_DIR, FOLDS_TABLE, args.formats,
+                                         compression=args.compress, log=write_log))
+            st["rows_out"] = len(folds)
+
+    # Wait for all output tables (re-raises a failed write)
+    with prof.stage("write_tables") as st:
+        for future in writes:
+            future.result()
+        io_pool.shutdown()
+        st["rows_out"] = len(write_log)
+
+    if args.incremental:
+        # Manifest + blocks for the next --incremental run
+        save_state(OUTPUT_DIR, delta, vessel, feature_cols, left_block, right_block)
+
+    metrics_fp = prof.write_json(os.path.join(OUTPUT_DIR, METRICS_NAME), mode="stream" if args.stream else "in_memory",
+                                 workers=args.workers, formats=args.formats, n_features=len(feature_cols),
+                                 mapping_status=stats["mapping_status"], qc=qc,
+                                 incremental=delta_summary(delta) if args.incremental else None,
+                                 cv_folds=fold_sizes(folds, args.cv_folds) if folds is not None else None,
+                                 writes=write_log)
+
+    # 10. Print a brief summary to console
+    tables = (IMAGE_TABLE, PARTICIPANT_TABLE, AGGREGATED_TABLE, EYE_USED_TABLE) + ((FOLDS_TABLE,) if folds is not None else ())
+    # (the streamed image-level master is only written as CSV)
+    saved = [table_path(OUTPUT_DIR, name, fmt, args.compress) for name in tables
+             for fmt in (["csv"] if args.stream and name == IMAGE_TABLE else args.formats)]
+    print(f"Saved: {', '.join(saved)}, {qc_fp}")
+    print("\n".join(format_write_log(write_log)))
+    print(qc)
+    if args.incremental:
+        print(f"Incremental: {delta_summary(delta)}")
+    if metrics_fp:
+        print(f"Metrics: {metrics_fp}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Stage-level benchmark of the image/participant QC pipeline on synthetic cohorts
+
+For every cohort size a realistic synthetic cohort is generated (synthetic_data.write_cohort) in a
+local temp directory and the pipeline stages of "Creating new image and participant level QC.py"
+are run and measured one by one:
+
+    load -> normalize -> eid_resolution -> pivot -> eye_selection -> qc -> write
+
+Per stage: wall time (best of --repeat runs), peak Python-heap allocation during the stage
+(tracemalloc, measured in one extra traced run; Arrow string buffers are not included) and the
+process peak RSS after the stage. Results go to a JSON file together with the commit and library
+versions, so runs can be compared across commits:
+
+    python benchmark_pipeline.py --sizes 10000 100000 1000000 --features 200 --out bench_new.json
+    python benchmark_pipeline.py --compare bench_old.json bench_new.json
+
+Nothing is read from or written to M:/; the temp directory is removed unless --keep is given.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from eid_index import build_eid_index
+from eye_selection import POLICIES
+from qc_pipeline import (aggregated_table, attach_eids, build_participant, eye_blocks, feature_columns, image_stats,
+                         normalize_images, normalize_participants, qc_counts)
+from stage_profiler import peak_rss_mb
+from synthetic_data import write_cohort
+from table_io import AGGREGATED_TABLE, EYE_USED_TABLE, FORMATS, IMAGE_TABLE, PARTICIPANT_TABLE, write_table
+
+STAGES = ("load", "normalize", "eid_resolution", "pivot", "eye_selection", "qc", "write")
+RESULTS_VERSION = 1
+
+
+class StageTimer:
+    """Collects wall time, traced peak memory and peak RSS per named stage."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def run(self, name, fn, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        entry = {"seconds": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb()}
+        if self.trace_memory:
+            entry["peak_traced_mb"] = round((tracemalloc.get_traced_memory()[1] - base) / (1 << 20), 1)
+        self.stages[name] = entry
+        return result
+
+
+def _load(vessel_fp, pat_fp):
+    return pd.read_csv(vessel_fp, low_memory=False), pd.read_csv(pat_fp, low_memory=False)
+
+
+def _normalize(vessel, pat):
+    normalize_participants(pat)
+    normalize_images(vessel)
+
+
+def _resolve(vessel, pat):
+    return attach_eids(vessel, build_eid_index(pat))
+
+
+def _pivot(vessel, pat):
+    feature_cols = feature_columns(vessel)
+    return feature_cols, *eye_blocks(vessel, feature_cols, pat["eid"])
+
+
+def _write(vessel, participant, agg, qc, out_dir, formats):
+    eye_used = participant["eye_used"]
+    write_table(vessel, out_dir, IMAGE_TABLE, formats)
+    write_table(participant, out_dir, PARTICIPANT_TABLE, formats, partition=eye_used)
+    write_table(agg, out_dir, AGGREGATED_TABLE, formats, partition=eye_used)
+    write_table(participant[["eid", "eye_used"]], out_dir, EYE_USED_TABLE, formats, partition=eye_used)
+    with open(os.path.join(out_dir, "qc_report.txt"), "w") as fh:
+        for k, v in qc.items():
+            fh.write(f"{k}: {v}\n")
+
+
+def run_pipeline(vessel_fp, pat_fp, out_dir, formats=("csv",), policy="left_first", trace_memory=False):
+    """Run all pipeline stages once; returns (stage measurements, qc counts)."""
+    t = StageTimer(trace_memory)
+    vessel, pat = t.run("load", _load, vessel_fp, pat_fp)
+    t.run("normalize", _normalize, vessel, pat)
+    vessel = t.run("eid_resolution", _resolve, vessel, pat)
+    feature_cols, left_block, right_block = t.run("pivot", _pivot, vessel, pat)
+    participant = t.run("eye_selection", build_participant, pat, left_block, right_block, feature_cols, policy)
+    qc = t.run("qc", lambda: qc_counts(image_stats(vessel), pat, participant))
+    agg = aggregated_table(participant, left_block, feature_cols)
+    t.run("write", _write, vessel, participant, agg, qc, out_dir, formats)
+    return t.stages, qc
+
+
+def benchmark_size(work_dir, n_images, n_features, seed, repeat, formats, policy, trace_memory):
+    """Generate one cohort and benchmark it; returns the result entry for the JSON file."""
+    cohort_dir = os.path.join(work_dir, f"cohort_{n_images}")
+    out_dir = os.path.join(cohort_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    vessel_fp, pat_fp, n_rows, n_participants = write_cohort(cohort_dir, n_images, n_features, seed)
+    entry = {
+        "n_images": n_images,
+        "n_vessel_rows": n_rows,
+        "n_participants": n_participants,
+        "n_features": n_features,
+        "generate_seconds": round(time.perf_counter() - start, 3),
+        "input_bytes": {"vessel": os.path.getsize(vessel_fp), "pat": os.path.getsize(pat_fp)},
+    }
+
+    runs = []
+    for _ in range(repeat):
+        stages, qc = run_pipeline(vessel_fp, pat_fp, out_dir, formats, policy)
+        runs.append(stages)
+    entry["stages"] = {name: {"seconds": round(min(r[name]["seconds"] for r in runs), 4),
+                              "peak_rss_mb": runs[-1][name]["peak_rss_mb"]} for name in STAGES}
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            traced, _ = run_pipeline(vessel_fp, pat_fp, out_dir, formats, policy, trace_memory=True)
+        finally:
+            tracemalloc.stop()
+        for name in STAGES:
+            entry["stages"][name]["peak_traced_mb"] = traced[name]["peak_traced_mb"]
+    entry["total_seconds"] = round(sum(s["seconds"] for s in entry["stages"].values()), 4)
+    entry["output_bytes"] = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(out_dir) for f in files)
+    entry["qc"] = qc
+    return entry
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        import pyarrow
+        pyarrow_version = pyarrow.__version__
+    except ImportError:
+        pyarrow_version = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "pyarrow": pyarrow_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare_results(old, new):
+    """Rows of (n_images, stage, old seconds, new seconds, new/old) for sizes present in both files."""
+    old_by_size = {r["n_images"]: r for r in old["results"]}
+    rows = []
+    for res in new["results"]:
+        base = old_by_size.get(res["n_images"])
+        if base is None:
+            continue
+        for name in STAGES + ("total",):
+            o = base["total_seconds"] if name == "total" else base["stages"][name]["seconds"]
+            n = res["total_seconds"] if name == "total" else res["stages"][name]["seconds"]
+            rows.append((res["n_images"], name, o, n, n / o if o else float("nan")))
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000], help="cohort sizes in images")
+    ap.add_argument("--features", type=int, default=100, help="number of feature columns")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=3, help="timed runs per size (best time is kept)")
+    ap.add_argument("--formats", nargs="+", choices=FORMATS, default=["csv"])
+    ap.add_argument("--policy", choices=POLICIES, default="left_first", help="eye selection policy")
+    ap.add_argument("--no-memory", action="store_true", help="skip the extra tracemalloc run")
+    ap.add_argument("--work-dir", default=None, help="directory for cohorts and outputs (default: a new temp dir)")
+    ap.add_argument("--keep", action="store_true", help="keep the generated cohorts and outputs")
+    ap.add_argument("--out", default="benchmark_pipeline.json", help="results JSON file")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results files and exit")
+    args = ap.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as fh_old, open(args.compare[1]) as fh_new:
+            old, new = json.load(fh_old), json.load(fh_new)
+        print(f"old: {old['environment']['commit']}  new: {new['environment']['commit']}")
+        for n_images, name, o, n, ratio in compare_results(old, new):
+            print(f"{n_images:>10}  {name:<15} {o:>10.3f}s {n:>10.3f}s  x{ratio:.2f}")
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="automorph_bench_")
+    results = {"version": RESULTS_VERSION, "environment": environment(), "results": [],
+               "config": {"features": args.features, "seed": args.seed, "repeat": args.repeat,
+                          "formats": args.formats, "policy": args.policy}}
+    try:
+        for n_images in args.sizes:
+            entry = benchmark_size(work_dir, n_images, args.features, args.seed, args.repeat, args.formats,
+                                   args.policy, not args.no_memory)
+            results["results"].append(entry)
+            print(f"{n_images} images ({entry['n_vessel_rows']} rows, {entry['n_participants']} participants): "
+                  f"{entry['total_seconds']:.2f}s")
+            for name, s in entry["stages"].items():
+                traced = f"  traced {s['peak_traced_mb']} MB" if "peak_traced_mb" in s else ""
+                print(f"  {name:<15} {s['seconds']:>9.3f}s  rss {s['peak_rss_mb']} MB{traced}")
+            # Rewrite after every size so partial results survive an interrupted large run
+            with open(args.out, "w") as fh:
+                json.dump(results, fh, indent=2)
+    finally:
+        if args.keep:
+            print(f"Kept cohorts and outputs in {work_dir}")
+        elif args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"Results: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Participant-grouped cross-validation fold index
+
+One row per participant (master_cv_folds), in the row order of the participant-level tables:
+
+    eid          participant
+    fold         0..k-1
+    eye_used     eye of the combined single-image features
+    combined_row row in master_participant_level_single_image(_aggregated) / master_participant_eye_used
+    left_row     row in master_participant_level_left_only(_aggregated), -1 if not in that view
+    right_row    row in master_participant_level_right_only(_aggregated), -1 if not in that view
+
+Folds are assigned per eid, so all images and both eyes of a participant are always in the same
+fold. Each eid gets a seeded 64-bit hash. Without stratification the fold is hash % k, so an eid
+keeps its fold when participants are added. With stratification, participants are ordered by
+stratum and hash and folds are dealt round-robin over the distinct eids (stratum of the first row
+of a repeated eid), so each stratum is spread evenly over the folds.
+Stratum columns are taken from the participant table. Numeric columns with more than
+MAX_STRATUM_LEVELS values are cut into quintiles, and missing values form their own stratum.
+
+Training jobs slice a fold directly, e.g. agg.iloc[folds.loc[folds.fold == 0, "combined_row"]].
+"""
+import numpy as np
+import pandas as pd
+
+FOLDS_TABLE = "master_cv_folds"
+DEFAULT_FOLDS = 5
+MAX_STRATUM_LEVELS = 10
+QUANTILE_BINS = 5
+
+
+def eid_hashes(eids, seed=0):
+    """Seeded uint64 hash of every eid (stable across runs, processes and eid dtypes).
+
+    Numeric eids (also numeric strings) are hashed as float64, so 1001, 1001.0 and "1001" agree;
+    other eids are hashed by their string value.
+    """
+    eids = pd.Series(eids)
+    numeric = pd.to_numeric(eids, errors="coerce").astype("float64")
+    h = pd.util.hash_array(numeric.to_numpy())
+    other = (numeric.isna() & eids.notna()).to_numpy()
+    if other.any():
+        h[other] = pd.util.hash_array(eids[other].astype(str).to_numpy(dtype=object))
+    key = pd.util.hash_array(np.array([seed], dtype="uint64"))[0]
+    return pd.util.hash_array(h ^ key)
+
+
+def stratum_codes(participant, columns):
+    """Integer stratum per participant row from the combination of `columns`."""
+    missing = [c for c in columns if c not in participant.columns]
+    if missing:
+        raise ValueError(f"stratification columns not in the participant table: {missing}")
+    codes = []
+    for col in columns:
+        values = participant[col]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values) \
+                and values.nunique() > MAX_STRATUM_LEVELS:
+            values = pd.qcut(values, QUANTILE_BINS, labels=False, duplicates="drop")
+        c = pd.factorize(values, sort=True)[0]
+        codes.append(np.where(c < 0, len(c), c))  # missing values: their own stratum, sorted last
+    if not codes:
+        return np.zeros(len(participant), dtype="int64")
+    return pd.MultiIndex.from_arrays(codes).factorize(sort=True)[0] if len(codes) > 1 else codes[0]
+
+
+def assign_folds(participant, n_folds=DEFAULT_FOLDS, seed=0, stratify=()):
+    """Fold (0..n_folds-1) of every participant row; see the module docstring for the rule."""
+    if n_folds < 2:
+        raise ValueError(f"n_folds must be at least 2, got {n_folds}")
+    h = eid_hashes(participant["eid"], seed)
+    if not stratify:
+        return (h % np.uint64(n_folds)).astype("int64")
+    # Deal the distinct eids (stratum of their first row), so repeated eids share one fold
+    eid_h, first, inverse = np.unique(h, return_index=True, return_inverse=True)
+    order = np.lexsort((eid_h, stratum_codes(participant, list(stratify))[first]))
+    folds = np.empty(len(eid_h), dtype="int64")
+    folds[order] = np.arange(len(eid_h)) % n_folds
+    return folds[inverse.reshape(-1)]
+
+
+def fold_index(participant, n_folds=DEFAULT_FOLDS, seed=0, stratify=()):
+    """The fold table for a participant-level table (must have eid and eye_used)."""
+    eye_used = participant["eye_used"].to_numpy(dtype=object)
+    out = pd.DataFrame({"eid": participant["eid"].to_numpy(), "fold": assign_folds(participant, n_folds, seed, stratify),
+                        "eye_used": eye_used, "combined_row": np.arange(len(participant))})
+    for eye in ("left", "right"):
+        sel = eye_used == eye
+        out[f"{eye}_row"] = np.where(sel, np.cumsum(sel) - 1, -1)
+    return out
+
+
+def fold_sizes(folds, n_folds):
+    """Participants per fold in the combined, left-only and right-only views."""
+    fold = folds["fold"].to_numpy()
+    return {view: np.bincount(fold[sel], minlength=n_folds).tolist()
+            for view, sel in (("combined", slice(None)), ("left", folds["left_row"].to_numpy() >= 0),
+                              ("right", folds["right_row"].to_numpy() >= 0))}
@@ -0,0 +1,211 @@
+"""
+Persistent filename -> eid index built from the participant table (retina_ckd_survival_ready_PAIRED.csv)
+
+The index is a long table with one row per (key_type, key, eid, eye):
+- key_type: 'stem' (filename without extension) or 'norm' (full normalized filename)
+- key:      normalized filename stem / full name (see fname_norm.py)
+- eid:      participant identifier listing that image
+- eye:      'left' or 'right' (from left_image_filename / right_image_filename)
+- n_eids:   number of distinct eids sharing the key (ambiguity count)
+- ambiguous: n_eids > 1
+
+It is cached next to the participant CSV and keyed on the file's SHA-256, so it is rebuilt
+automatically whenever the participant file changes.
+
+UK Biobank fundus filenames encode the participant themselves: <eid>_<field>_<instance>_<array>
+with field 21015 = left and 21016 = right. resolve_eids_ukb parses those names directly and uses the
+join above only for names that do not follow the pattern or disagree with the participant table.
+"""
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from fname_norm import STRING_DTYPE, normalize_filenames
+
+INDEX_VERSION = 1
+INDEX_COLUMNS = ["key_type", "key", "eid", "eye", "n_eids", "ambiguous"]
+MAPPING_STATUSES = ("stem_matched", "full_matched", "unmatched", "filename_parsed")
+# Normalized UK Biobank stem: eid, field (21015 left / 21016 right), instance (visit), array index
+UKB_STEM_RE = r"^(\d+)_(2101[56])_(\d+)_(\d+)$"
+UKB_LEFT_RE = r"^\d+_21015_"
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def default_cache_path(pat_fp):
+    root, _ = os.path.splitext(pat_fp)
+    return root + ".eid_index.pkl"
+
+
+def build_eid_index(pat):
+    """Build the index from a participant DataFrame with eid/left_image_filename/right_image_filename."""
+    parts = []
+    for eye in ("left", "right"):
+        n = normalize_filenames(pat[f"{eye}_image_filename"])
+        for key_type in ("stem", "norm"):
+            parts.append(pd.DataFrame({"key_type": key_type, "key": n[key_type], "eid": pat["eid"], "eye": eye}))
+    idx = pd.concat(parts, ignore_index=True)
+    idx = idx.dropna(subset=["key", "eid"]).drop_duplicates()
+    idx["n_eids"] = idx.groupby(["key_type", "key"])["eid"].transform("nunique").astype("int32")
+    idx["ambiguous"] = idx["n_eids"] > 1
+    idx["key_type"] = idx["key_type"].astype("category")
+    idx["eye"] = idx["eye"].astype("category")
+    return idx[INDEX_COLUMNS].sort_values(["key_type", "key", "eid", "eye"]).reset_index(drop=True)
+
+
+def load_eid_index(pat_fp, cache_fp=None, rebuild=False):
+    """Load the cached index for `pat_fp`, rebuilding it if missing, stale or `rebuild` is set."""
+    cache_fp = cache_fp or default_cache_path(pat_fp)
+    digest = file_sha256(pat_fp)
+    if not rebuild and os.path.exists(cache_fp):
+        try:
+            with open(cache_fp, "rb") as fh:
+                cached = pickle.load(fh)
+            if cached.get("version") == INDEX_VERSION and cached.get("sha256") == digest:
+                return cached["index"]
+        except Exception:
+            pass  # unreadable cache (corrupt, or pickled with another pandas / without pyarrow): rebuild
+    pat = pd.read_csv(pat_fp, low_memory=False, usecols=["eid", "left_image_filename", "right_image_filename"])
+    idx = build_eid_index(pat)
+    tmp_fp = cache_fp + ".tmp"
+    with open(tmp_fp, "wb") as fh:
+        pickle.dump({"version": INDEX_VERSION, "sha256": digest, "index": idx}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fp, cache_fp)
+    return idx
+
+
+def participant_stems(index):
+    """One row per eid with its left/right filename stems (first stem if an eid lists several)."""
+    sel = index.loc[index["key_type"] == "stem", ["eid", "eye", "key"]].drop_duplicates(["eid", "eye"])
+    wide = sel.pivot(index="eid", columns="eye", values="key")
+    wide = wide.reindex(columns=["left", "right"]).rename(columns={"left": "left_fname_stem", "right": "right_fname_stem"})
+    wide.columns.name = None
+    return wide.reset_index()
+
+
+def key_summary(index, key_type):
+    """One row per key: the unique eid (NaN if ambiguous), its eye ('left'/'right'/'both') and n_eids."""
+    sel = index.loc[index["key_type"] == key_type, ["key", "eid", "eye", "n_eids"]]
+    eyes = sel.assign(is_left=sel["eye"] == "left", is_right=sel["eye"] == "right")
+    g = eyes.groupby("key", sort=False, observed=True).agg(
+        eid=("eid", "first"), n_eids=("n_eids", "first"), is_left=("is_left", "any"), is_right=("is_right", "any"))
+    eye = np.select([g["is_left"] & g["is_right"], g["is_left"], g["is_right"]], ["both", "left", "right"], default=None)
+    unique = g["n_eids"].to_numpy() == 1
+    return pd.DataFrame({
+        "eid": g["eid"].where(unique),
+        "eye": pd.Series(eye, index=g.index).where(unique),
+        "n_eids": g["n_eids"],
+    }, index=g.index)
+
+
+def resolve_eids(stems, norms, index):
+    """Resolve image rows to participants: stem match first, then full normalized name.
+
+    `stems` and `norms` are aligned Series of normalized filename stems / full names. Returns a
+    DataFrame on the same index with matched_eid_stem, matched_eid_full, eid, matched_eye
+    ('left'/'right'/'both'), mapping_status ('stem_matched'/'full_matched'/'unmatched') and
+    n_candidate_eids (eids listing the image's stem, or its full name if the stem is unknown).
+    """
+    hits = {}
+    for key_type, keys in (("stem", stems), ("norm", norms)):
+        summ = key_summary(index, key_type)
+        # Hash join of every row's key against the per-key summary (unlisted keys give NaN)
+        hits[key_type] = summ.reindex(pd.Index(keys.astype(summ.index.dtype)))
+    stem, full = hits["stem"], hits["norm"]
+    stem_hit = stem["eid"].notna().to_numpy()
+    full_hit = ~stem_hit & full["eid"].notna().to_numpy()
+    eid_dtype = "Int64" if pd.api.types.is_integer_dtype(index["eid"]) else index["eid"].dtype
+    out = pd.DataFrame(index=stems.index)
+    out["matched_eid_stem"] = pd.array(stem["eid"].to_numpy(), dtype=eid_dtype)
+    out["matched_eid_full"] = pd.array(full["eid"].to_numpy(), dtype=eid_dtype)
+    out["eid"] = out["matched_eid_stem"].where(stem_hit, out["matched_eid_full"])
+    stem_eye = stem["eye"].to_numpy(dtype=object)
+    full_eye = full["eye"].to_numpy(dtype=object)
+    # A participant listing e.g. x.jpg (left) and x.png (right) shares one stem across both eyes;
+    # the full name then tells which eye this particular image is
+    refine = stem_hit & (stem_eye == "both") & (out["matched_eid_full"] == out["matched_eid_stem"]).fillna(False).to_numpy()
+    refine &= np.isin(full_eye, ["left", "right"])
+    out["matched_eye"] = np.where(refine, full_eye, np.where(stem_hit, stem_eye, np.where(full_hit, full_eye, None)))
+    out["mapping_status"] = np.select([stem_hit, full_hit], list(MAPPING_STATUSES[:2]), default=MAPPING_STATUSES[2])
+    n_stem = stem["n_eids"].fillna(0).to_numpy(dtype="int32")
+    n_full = full["n_eids"].fillna(0).to_numpy(dtype="int32")
+    out["n_candidate_eids"] = np.where(n_stem > 0, n_stem, n_full)
+    return out
+
+
+def parse_ukb_stems(stems, instances=True):
+    """eid, eye, ukb_instance and ukb_array parsed from normalized UK Biobank stems (<NA> where the
+    stem does not follow UKB_STEM_RE); same index as `stems`. instances=False skips the last two."""
+    s = pd.Series(stems, copy=False).astype(STRING_DTYPE)
+    ok = s.str.fullmatch(UKB_STEM_RE).fillna(False).to_numpy(dtype=bool)
+    sub = s[ok]
+    out = pd.DataFrame({"eid": pd.array(np.full(len(s), np.nan), dtype="Int64"), "eye": np.full(len(s), None, dtype=object),
+                        "ukb_instance": pd.array(np.full(len(s), np.nan), dtype="Int64"),
+                        "ukb_array": pd.array(np.full(len(s), np.nan), dtype="Int64")}, index=s.index)
+    for col, group in (("eid", 1), ("ukb_instance", 3), ("ukb_array", 4))[:3 if instances else 1]:
+        out.loc[ok, col] = sub.str.replace(UKB_STEM_RE, rf"\{group}", regex=True).astype("Int64").to_numpy()
+    out.loc[ok, "eye"] = np.where(sub.str.contains(UKB_LEFT_RE).to_numpy(dtype=bool), "left", "right")
+    return out
+
+
+def ukb_conflict_keys(index):
+    """Listed stems that parse as UK Biobank names but are listed under another eid or eye (or several eids)."""
+    listed = index.loc[index["key_type"] == "stem", ["key", "eid", "eye", "n_eids"]]
+    parsed = parse_ukb_stems(listed["key"], instances=False)
+    other = (parsed["eid"].to_numpy(dtype="float64", na_value=np.nan) != listed["eid"].to_numpy(dtype="float64"))
+    other |= parsed["eye"].to_numpy() != listed["eye"].to_numpy(dtype=object)
+    other |= listed["n_eids"].to_numpy() > 1
+    return listed.loc[parsed["eid"].notna().to_numpy() & other, "key"].unique()
+
+
+def resolve_eids_ukb(stems, norms, index):
+    """resolve_eids with eid and eye parsed from UK Biobank filenames where possible.
+
+    A parsed name is used when its eid is in the index (a cohort participant) and the participant
+    table does not list its stem under another eid or eye; those rows get mapping_status
+    'filename_parsed'. All other rows go through resolve_eids. Adds ukb_instance / ukb_array (for
+    every parseable name), filename_conflict: the parsed eid/eye disagrees with the participant
+    table, so the join result was kept, and filename_unlisted: the parsed eid/eye was used although
+    the participant table does not list the image (the join would leave it unmatched, and the
+    participant may list another image for that eye).
+    """
+    parsed = parse_ukb_stems(stems)
+    has_eid = parsed["eid"].notna().to_numpy()
+    conflict = has_eid & stems.isin(ukb_conflict_keys(index)).to_numpy(dtype=bool)
+    cohort = parsed["eid"].isin(index["eid"].unique()).to_numpy(dtype=bool)
+    use = has_eid & cohort & ~conflict
+
+    # The join only needs the index rows of the remaining names (n_eids is precomputed per key)
+    rest_keys = pd.concat([stems[~use], norms[~use]]).dropna().unique()
+    joined = resolve_eids(stems[~use], norms[~use], index[index["key"].isin(rest_keys).to_numpy()])
+    eid_dtype = joined["eid"].dtype
+    n = int(use.sum())
+    direct = pd.DataFrame({
+        "matched_eid_stem": pd.array(np.full(n, np.nan), dtype=eid_dtype),
+        "matched_eid_full": pd.array(np.full(n, np.nan), dtype=eid_dtype),
+        "eid": pd.array(parsed["eid"].to_numpy()[use], dtype=eid_dtype),
+        "matched_eye": parsed["eye"].to_numpy()[use],
+        "mapping_status": MAPPING_STATUSES[3],
+        "n_candidate_eids": np.ones(n, dtype="int32"),
+    })
+    # Back to the input row order (positional, so duplicate index labels are fine)
+    order = np.concatenate([np.flatnonzero(use), np.flatnonzero(~use)])
+    out = pd.concat([direct, joined.reset_index(drop=True)], ignore_index=True).iloc[np.argsort(order, kind="stable")]
+    out.index = stems.index
+    out = out.astype({"matched_eye": joined["matched_eye"].dtype, "n_candidate_eids": "int32"})
+    out["ukb_instance"] = parsed["ukb_instance"]
+    out["ukb_array"] = parsed["ukb_array"]
+    out["filename_conflict"] = conflict
+    unlisted = np.zeros(len(stems), dtype=bool)
+    unlisted[use] = ~stems[use].isin(index.loc[index["key_type"] == "stem", "key"].unique()).to_numpy(dtype=bool)
+    out["filename_unlisted"] = unlisted
+    return out
@@ -1,26 +1,14 @@
-import pandas as pd
-import os
+from table_io import AGGREGATED_TABLE, LEFT_ONLY_AGGREGATED_TABLE, LEFT_ONLY_TABLE, PARTICIPANT_TABLE, read_table, table_path
 
 OUTPUT_DIR = r"M:/NEW-PROJECT/AUTOMORPH"
 
-full_fp = os.path.join(OUTPUT_DIR, 'master_participant_level_single_image.csv')
-agg_fp = os.path.join(OUTPUT_DIR, 'master_participant_level_single_image_aggregated.csv')
-eyes_fp = os.path.join(OUTPUT_DIR, 'master_participant_eye_used.csv')
+out_full = table_path(OUTPUT_DIR, LEFT_ONLY_TABLE, 'csv')
+out_agg = table_path(OUTPUT_DIR, LEFT_ONLY_AGGREGATED_TABLE, 'csv')
 
-out_full = os.path.join(OUTPUT_DIR, 'master_participant_level_left_only.csv')
-out_agg = os.path.join(OUTPUT_DIR, 'master_participant_level_left_only_aggregated.csv')
-
-# Load
-full = pd.read_csv(full_fp, low_memory=False)
-agg = pd.read_csv(agg_fp, low_memory=False)
-eyes = pd.read_csv(eyes_fp, low_memory=False)
-
-# Merge eye_used into agg if needed
-agg = agg.merge(eyes, on='eid', how='left')
-
-# Filter where eye_used == 'left'
-full_left = full[full['used_left'] == True].copy()
-agg_left = agg[agg['eye_used'] == 'left'].copy()
+# Load only the left-eye rows (partitioned Parquet/Feather outputs are used when present, otherwise the CSVs;
+# CSV aggregated rows get eye_used from master_participant_eye_used.csv)
+full_left = read_table(OUTPUT_DIR, PARTICIPANT_TABLE, eye_used='left')
+agg_left = read_table(OUTPUT_DIR, AGGREGATED_TABLE, eye_used='left')
 
 # Save
 full_left.to_csv(out_full, index=False)
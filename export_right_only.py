@@ -1,27 +1,14 @@
-import pandas as pd
-import os
+from table_io import AGGREGATED_TABLE, PARTICIPANT_TABLE, RIGHT_ONLY_AGGREGATED_TABLE, RIGHT_ONLY_TABLE, read_table, table_path
 
 OUTPUT_DIR = r"M:/NEW-PROJECT/AUTOMORPH"
 
-full_fp = os.path.join(OUTPUT_DIR, 'master_participant_level_single_image.csv')
-agg_fp = os.path.join(OUTPUT_DIR, 'master_participant_level_single_image_aggregated.csv')
-eyes_fp = os.path.join(OUTPUT_DIR, 'master_participant_eye_used.csv')
+out_full = table_path(OUTPUT_DIR, RIGHT_ONLY_TABLE, 'csv')
+out_agg = table_path(OUTPUT_DIR, RIGHT_ONLY_AGGREGATED_TABLE, 'csv')
 
-out_full = os.path.join(OUTPUT_DIR, 'master_participant_level_right_only.csv')
-out_agg = os.path.join(OUTPUT_DIR, 'master_participant_level_right_only_aggregated.csv')
-
-# Load
-full = pd.read_csv(full_fp, low_memory=False)
-agg = pd.read_csv(agg_fp, low_memory=False)
-eyes = pd.read_csv(eyes_fp, low_memory=False)
-
-# Merge eye_used into agg if needed
-agg = agg.merge(eyes, on='eid', how='left')
-
-# Filter where eye_used == 'right'
-# Note: full has 'used_right' boolean flag; agg uses 'eye_used'
-full_right = full[full['used_right'] == True].copy()
-agg_right = agg[agg['eye_used'] == 'right'].copy()
+# Load only the right-eye rows (partitioned Parquet/Feather outputs are used when present, otherwise the CSVs;
+# CSV aggregated rows get eye_used from master_participant_eye_used.csv)
+full_right = read_table(OUTPUT_DIR, PARTICIPANT_TABLE, eye_used='right')
+agg_right = read_table(OUTPUT_DIR, AGGREGATED_TABLE, eye_used='right')
 
 # Save
 full_right.to_csv(out_full, index=False)
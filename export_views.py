@@ -0,0 +1,105 @@
+"""
+Single-pass multi-view exporter
+
+Builds the image-level and participant-level tables in memory once (same stages as
+"Creating new image and participant level QC.py") and writes every requested view from them,
+instead of running the main script and then export_left_only.py / export_right_only.py, each of
+which re-reads the master CSVs.
+
+Views:
+- combined: master_participant_level_single_image, ..._aggregated, master_participant_eye_used
+- left:     master_participant_level_left_only, ..._left_only_aggregated (eye_used == 'left')
+- right:    master_participant_level_right_only, ..._right_only_aggregated (eye_used == 'right')
+- both:     master_participant_level_both_eyes (participants with both eyes; eid + left_*/right_* features)
+- image:    master_image_level
+
+Also writes qc_report.txt and export_manifest.json (row counts and paths per view, bytes and write
+seconds per file). The inputs are read concurrently and the tables written from a thread pool;
+--compress gzip|zstd compresses the CSVs (.csv.gz / .csv.zst, read transparently by table_io).
+
+Usage: python export_views.py [--views combined left right both image] [--formats csv parquet] [--compress gzip]
+"""
+import argparse
+import json
+import os
+
+from eye_selection import POLICIES
+from pipeline import read_inputs, write_qc_report
+from qc_pipeline import build_master_tables
+from table_io import (AGGREGATED_TABLE, BOTH_EYES_TABLE, COMPRESSIONS, DEFAULT_IO_THREADS, EYE_USED_TABLE, FORMATS,
+                      IMAGE_TABLE, LEFT_ONLY_AGGREGATED_TABLE, LEFT_ONLY_TABLE, PARTICIPANT_TABLE,
+                      RIGHT_ONLY_AGGREGATED_TABLE, RIGHT_ONLY_TABLE, write_tables)
+
+ROOT = r"M:/NEW-PROJECT/AUTOMORPH"
+VIEWS = ("combined", "left", "right", "both", "image")
+MANIFEST_NAME = "export_manifest.json"
+
+
+def view_tables(tables, view):
+    """{table name: (DataFrame, eye_used partition or None)} for one view of the master tables."""
+    participant, agg = tables["participant"], tables["aggregated"]
+    eye_used = participant["eye_used"]
+    if view == "combined":
+        return {
+            PARTICIPANT_TABLE: (participant, eye_used),
+            AGGREGATED_TABLE: (agg, eye_used),
+            EYE_USED_TABLE: (participant[["eid", "eye_used"]], eye_used),
+        }
+    if view in ("left", "right"):
+        sel = (eye_used == view).to_numpy()
+        full_name, agg_name = ((LEFT_ONLY_TABLE, LEFT_ONLY_AGGREGATED_TABLE) if view == "left"
+                               else (RIGHT_ONLY_TABLE, RIGHT_ONLY_AGGREGATED_TABLE))
+        return {full_name: (participant[sel], None), agg_name: (agg[sel], None)}
+    if view == "both":
+        cols = ["eid"] + [f"{eye}_{c}" for eye in ("left", "right") for c in tables["feature_cols"]]
+        sel = (participant["has_left_features"] & participant["has_right_features"]).to_numpy()
+        return {BOTH_EYES_TABLE: (participant.loc[sel, cols], None)}
+    if view == "image":
+        return {IMAGE_TABLE: (tables["image"], None)}
+    raise ValueError(f"unknown view {view!r}; expected one of {VIEWS}")
+
+
+def export_views(tables, out_dir, views=VIEWS, formats=("csv",), compression=None, io_threads=DEFAULT_IO_THREADS):
+    """Write the requested views of in-memory master tables; returns the manifest dict."""
+    views = {view: view_tables(tables, view) for view in views}
+    jobs = [dict(df=df, out_dir=out_dir, name=name, formats=formats, partition=partition, compression=compression)
+            for entries in views.values() for name, (df, partition) in entries.items()]
+    log = []
+    saved = write_tables(jobs, io_threads, log)
+    manifest = {"views": {}, "qc": tables["qc"], "writes": log}
+    for view, entries in views.items():
+        manifest["views"][view] = {name: {"rows": len(df), "paths": saved[name]} for name, (df, _) in entries.items()}
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w") as fh:
+        json.dump(manifest, fh, indent=2)
+    return manifest
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--vessel", default=os.path.join(ROOT, "vessel_features_merged.csv"))
+    ap.add_argument("--pat", default=os.path.join(ROOT, "retina_ckd_survival_ready_PAIRED.csv"))
+    ap.add_argument("--out-dir", default=ROOT)
+    ap.add_argument("--views", nargs="+", choices=VIEWS, default=list(VIEWS))
+    ap.add_argument("--formats", nargs="+", choices=FORMATS, default=["csv"])
+    ap.add_argument("--policy", choices=POLICIES, default="left_first", help="eye selection for the combined features")
+    ap.add_argument("--quality-col", default=None, help="image-level quality column for --policy best_quality")
+    ap.add_argument("--compress", choices=COMPRESSIONS, default=None, help="compress the CSV outputs")
+    ap.add_argument("--io-threads", type=int, default=DEFAULT_IO_THREADS, help="threads writing the output tables")
+    args = ap.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    vessel, pat, eid_index = read_inputs(args.vessel, args.pat, None)
+    tables = build_master_tables(vessel, pat, eid_index, args.policy, args.quality_col)
+
+    write_qc_report(tables["qc"], args.out_dir)
+    manifest = export_views(tables, args.out_dir, args.views, args.formats, args.compress, args.io_threads)
+
+    print(f"Saved views to {args.out_dir} ({', '.join(args.formats)}):")
+    for view, entries in manifest["views"].items():
+        for name, entry in entries.items():
+            print(f"  {view:<9} {name}: {entry['rows']} rows")
+    print(f"Manifest: {os.path.join(args.out_dir, MANIFEST_NAME)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Image-level vascular features from AutoMorph vessel masks / probability maps
+
+Reads every mask PNG in a directory, binarizes it with NumPy (vessel = value >= threshold of the
+full intensity range; 0/1 masks are used as they are) and computes the twelve image-level parameters:
+
+    height, width                       image dimensions (px)
+    area_px                             vessel pixels
+    vessel_density                      area_px / (height * width)
+    fractal_dimension                   box-counting dimension of the vessel mask
+    average_width                       mean vessel calibre, 2 * area / boundary length (px)
+    artery_/vein_vessel_density         the same for the artery (red) and vein (blue) channels of an
+    artery_/vein_fractal_dimension      AutoMorph artery/vein map; NaN for single-channel vessel masks
+    artery_/vein_average_width
+
+Rows are written to vessel_features_merged.csv (original_filename + features), the table the QC
+script consumes. Images are processed in batches in a process pool and every finished batch is
+appended straight away, in file-name order. Rerunning resumes: images already in the output are
+skipped (a row cut short by an interrupted run is discarded first). Unreadable images are reported
+and left out, so they are retried on the next run.
+
+Reading PNGs requires Pillow (pip install pillow).
+
+Usage: python extract_mask_features.py --masks-dir M:/AUTOMORPH/Results/M2/binary_vessel/raw_binary --workers 8
+"""
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ROOT = r"M:/NEW-PROJECT/AUTOMORPH"
+FEATURES = ["height", "width", "area_px", "vessel_density", "fractal_dimension", "average_width",
+            "artery_vessel_density", "vein_vessel_density", "artery_fractal_dimension", "vein_fractal_dimension",
+            "artery_average_width", "vein_average_width"]
+OUTPUT_COLUMNS = ["original_filename"] + FEATURES
+DEFAULT_BATCH_SIZE = 64
+
+
+def read_mask(path):
+    """Image as a 2-D (gray) or 3-D (RGB) NumPy array; alpha channels are dropped."""
+    if Image is None:
+        raise ImportError("reading mask PNGs requires Pillow (pip install pillow)")
+    with Image.open(path) as im:
+        arr = np.asarray(im.convert("RGB") if im.mode in ("P", "RGBA", "LA") else im)
+    if arr.ndim == 3 and arr.shape[2] == 4:
+        arr = arr[:, :, :3]
+    return arr
+
+
+def binarize(arr, threshold=0.5):
+    """Boolean mask: value >= threshold * full range (0/1 masks: value >= threshold)."""
+    if arr.dtype == bool:
+        return arr
+    full = 1 if arr.max(initial=0) <= 1 else (np.iinfo(arr.dtype).max if arr.dtype.kind in "ui" else 1.0)
+    return arr >= threshold * full
+
+
+def fractal_dimension(mask):
+    """Box-counting dimension (boxes of 2..N/2 px on the zero-padded power-of-two square)."""
+    if not mask.any():
+        return np.nan
+    size = 1 << int(np.ceil(np.log2(max(mask.shape))))
+    if size < 8:
+        return np.nan
+    square = np.zeros((size, size), dtype=bool)
+    square[:mask.shape[0], :mask.shape[1]] = mask
+    sizes = 2 ** np.arange(1, int(np.log2(size)))
+    counts = np.array([square.reshape(size // s, s, size // s, s).any(axis=(1, 3)).sum() for s in sizes])
+    return float(-np.polyfit(np.log(sizes), np.log(counts), 1)[0])
+
+
+def average_width(mask):
+    """Mean vessel calibre in px: vessel area over half the boundary length (a thin ribbon of width w
+    and length L has area w*L and boundary ~2L)."""
+    padded = np.pad(mask, 1)
+    boundary = np.count_nonzero(padded[1:, :] != padded[:-1, :]) + np.count_nonzero(padded[:, 1:] != padded[:, :-1])
+    return 2.0 * np.count_nonzero(mask) / boundary if boundary else np.nan
+
+
+def _is_artery_vein_map(arr):
+    return arr.ndim == 3 and not (np.array_equal(arr[..., 0], arr[..., 1]) and np.array_equal(arr[..., 0], arr[..., 2]))
+
+
+def vessel_mask(arr, threshold=0.5):
+    """2-D boolean vessel mask of a gray mask / probability map or an RGB artery/vein map (any channel)."""
+    if _is_artery_vein_map(arr):
+        return binarize(arr, threshold).any(axis=2)
+    return binarize(arr[..., 0] if arr.ndim == 3 else arr, threshold)
+
+
+def mask_features(arr, threshold=0.5):
+    """The FEATURES of one mask array (artery/vein features only for RGB artery/vein maps)."""
+    height, width = arr.shape[:2]
+    channels = _is_artery_vein_map(arr)
+    vessel = vessel_mask(arr, threshold)
+    area = int(np.count_nonzero(vessel))
+    row = {"height": height, "width": width, "area_px": area, "vessel_density": area / (height * width),
+           "fractal_dimension": fractal_dimension(vessel), "average_width": average_width(vessel)}
+    for name, channel in (("artery", 0), ("vein", 2)):
+        sub = binarize(arr[..., channel], threshold) if channels else None
+        row[f"{name}_vessel_density"] = np.count_nonzero(sub) / (height * width) if channels else np.nan
+        row[f"{name}_fractal_dimension"] = fractal_dimension(sub) if channels else np.nan
+        row[f"{name}_average_width"] = average_width(sub) if channels else np.nan
+    return row
+
+
+def extract_batch(paths, threshold=0.5):
+    """Feature rows (in `paths` order) and (path, error) pairs for images that could not be read."""
+    rows, failed = [], []
+    for path in paths:
+        try:
+            row = mask_features(read_mask(path), threshold)
+        except ImportError:
+            raise
+        except Exception as e:  # corrupt / truncated / unsupported image: skip, retried on the next run
+            failed.append((path, f"{type(e).__name__}: {e}"))
+            continue
+        rows.append({"original_filename": os.path.basename(path), **row})
+    return pd.DataFrame(rows, columns=OUTPUT_COLUMNS), failed
+
+
+def extracted_filenames(out_fp):
+    """original_filename values already in out_fp; drops a trailing partial row left by an interrupted run."""
+    if not os.path.exists(out_fp) or os.path.getsize(out_fp) == 0:
+        return set()
+    with open(out_fp, "rb+") as fh:
+        data = fh.read()
+        if not data.endswith(b"\n"):
+            fh.truncate(data.rfind(b"\n") + 1)
+    header = list(pd.read_csv(out_fp, nrows=0).columns)
+    if header != OUTPUT_COLUMNS:
+        raise ValueError(f"{out_fp} has columns {header}, expected {OUTPUT_COLUMNS}; use another --out")
+    return set(pd.read_csv(out_fp, usecols=["original_filename"], dtype=str)["original_filename"])
+
+
+def pending_masks(masks_dir, pattern, out_fp):
+    """Sorted mask paths in masks_dir not yet in out_fp."""
+    paths = sorted(glob.glob(os.path.join(masks_dir, pattern)))
+    done = extracted_filenames(out_fp)
+    return [p for p in paths if os.path.basename(p) not in done]
+
+
+def extract_features(paths, out_fp, workers=1, batch_size=DEFAULT_BATCH_SIZE, threshold=0.5):
+    """Extract `paths` in batches over `workers` processes, appending rows to out_fp in path order.
+
+    Returns (n_rows_written, failed) with failed a list of (path, error).
+    """
+    if Image is None:
+        raise ImportError("reading mask PNGs requires Pillow (pip install pillow)")
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    header = not os.path.exists(out_fp) or os.path.getsize(out_fp) == 0
+    n_rows, failed = 0, []
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    results = pool.map(extract_batch, batches, repeat(threshold)) if pool else map(extract_batch, batches, repeat(threshold))
+    try:
+        for rows, batch_failed in results:
+            rows.to_csv(out_fp, index=False, mode="a", header=header)
+            header = False
+            n_rows += len(rows)
+            failed.extend(batch_failed)
+    finally:
+        if pool:
+            pool.shutdown()
+    return n_rows, failed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--masks-dir", required=True, help="directory with AutoMorph vessel masks / probability maps")
+    ap.add_argument("--pattern", default="*.png", help="glob for mask files inside --masks-dir")
+    ap.add_argument("--out", default=os.path.join(ROOT, "vessel_features_merged.csv"))
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="images read per task")
+    ap.add_argument("--threshold", type=float, default=0.5, help="binarization threshold as a fraction of full intensity")
+    args = ap.parse_args()
+
+    paths = pending_masks(args.masks_dir, args.pattern, args.out)
+    print(f"{len(paths)} masks to extract into {args.out}")
+    n_rows, failed = extract_features(paths, args.out, args.workers, args.batch_size, args.threshold)
+    print(f"Extracted {n_rows} images")
+    if failed:
+        print(f"{len(failed)} images could not be read (will be retried on the next run):", file=sys.stderr)
+        for path, err in failed:
+            print(f"  {path}: {err}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Vectorized participant eye-coverage engine
+
+Coverage is a 2-bit code per image row / participant:
+    0 = none, 1 = left, 2 = right, 3 = both (left | right)
+
+An image row's code says whether its filename stem is listed as a left and/or right image by any
+participant; a participant's code ORs the eyes of all their listed images present in the vessel
+table (ambiguous stems count for every eid listing them, as in count_right_drops.py).
+Everything is computed with joins on unique stems and a groupby, never per row.
+"""
+import numpy as np
+import pandas as pd
+
+COVERAGE_NONE, COVERAGE_LEFT, COVERAGE_RIGHT, COVERAGE_BOTH = 0, 1, 2, 3
+COVERAGE_LABELS = {COVERAGE_NONE: "none", COVERAGE_LEFT: "left", COVERAGE_RIGHT: "right", COVERAGE_BOTH: "both"}
+
+
+def _or_bits(keys, bits):
+    """Bitwise OR of `bits` per key (bits are single flags, so OR = sum of the distinct flags)."""
+    df = pd.DataFrame({"key": keys, "bit": bits}).drop_duplicates()
+    return df.groupby("key", sort=False)["bit"].sum().astype("int8")
+
+
+def eye_coverage(stems, eid_index, eids):
+    """Coverage codes for image rows and participants.
+
+    `stems` are normalized filename stems of the vessel rows, `eids` the participant ids to report on.
+    Returns (row_codes, eid_codes): an int8 array aligned to `stems` and an int8 Series indexed by `eids`.
+    """
+    sel = eid_index.loc[eid_index["key_type"] == "stem", ["key", "eid", "eye"]]
+    bits = np.where(sel["eye"].to_numpy() == "left", COVERAGE_LEFT, COVERAGE_RIGHT).astype("int8")
+
+    # Row level: which eyes list each stem at all
+    stem_codes = _or_bits(sel["key"].to_numpy(), bits)
+    stems = pd.Series(stems, copy=False).astype(sel["key"].dtype)
+    row_codes = stems.map(stem_codes).fillna(COVERAGE_NONE).to_numpy(dtype="int8")
+
+    # Participant level: eyes of each eid's listed images that occur in the vessel table
+    # (hash semi-join of the index keys against the distinct vessel stems)
+    present = pd.Index(stems.dropna().unique()).get_indexer(sel["key"]) >= 0
+    per_eid = _or_bits(sel["eid"].to_numpy()[present], bits[present])
+    eid_codes = per_eid.reindex(pd.Index(eids)).fillna(COVERAGE_NONE).astype("int8")
+    return row_codes, eid_codes
+
+
+def coverage_counts(codes):
+    """{'none': n, 'left': n, 'right': n, 'both': n} for an array of coverage codes."""
+    counts = np.bincount(np.asarray(codes, dtype="int64"), minlength=4)
+    return {COVERAGE_LABELS[c]: int(counts[c]) for c in (COVERAGE_LEFT, COVERAGE_RIGHT, COVERAGE_BOTH, COVERAGE_NONE)}
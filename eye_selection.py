@@ -0,0 +1,72 @@
+"""
+Block-wise eye selection for the participant table
+
+Left and right features are handled as two aligned 2-D float blocks (participants x features),
+so choosing the eye per participant is a handful of NumPy operations regardless of how many
+feature columns there are.
+
+Selection policies:
+- left_first:   left value where present, otherwise right (per feature); eye_used = left if any left feature
+- right_first:  mirror image of left_first
+- mean:         mean of the available eyes per feature; eye_used = both / left / right
+- best_quality: whole feature vector from the eye with the higher quality score (ties -> left);
+                the quality score defaults to the number of non-missing features
+"""
+import numpy as np
+import pandas as pd
+
+POLICIES = ("left_first", "right_first", "mean", "best_quality")
+
+
+def feature_block(df, cols):
+    """2-D float64 array of `cols` (missing/non-numeric -> NaN) aligned to df's rows."""
+    if not cols:
+        return np.empty((len(df), 0))
+    block = df[cols].apply(pd.to_numeric, errors="coerce")
+    return block.to_numpy(dtype="float64", na_value=np.nan)
+
+
+def _prefer(first, second, first_name, second_name):
+    values = np.where(np.isnan(first), second, first)
+    has_first = ~np.isnan(first).all(axis=1)
+    has_second = ~np.isnan(second).all(axis=1)
+    eye = np.where(has_first, first_name, np.where(has_second, second_name, None))
+    return values, eye
+
+
+def select_eye(left, right, policy="left_first", left_quality=None, right_quality=None):
+    """Combine aligned left/right feature blocks into one block.
+
+    Returns (values, eye_used) where eye_used is an object array of 'left'/'right'/'both'/None.
+    """
+    # Keep float32 blocks (streaming ingestion) in float32; anything else is promoted to float64
+    dtype = np.result_type(np.asarray(left).dtype, np.asarray(right).dtype, np.float32)
+    left = np.asarray(left, dtype=dtype)
+    right = np.asarray(right, dtype=dtype)
+    if left.shape != right.shape:
+        raise ValueError(f"left/right blocks differ in shape: {left.shape} vs {right.shape}")
+    if policy == "left_first":
+        return _prefer(left, right, "left", "right")
+    if policy == "right_first":
+        return _prefer(right, left, "right", "left")
+
+    has_left = ~np.isnan(left).all(axis=1)
+    has_right = ~np.isnan(right).all(axis=1)
+    if policy == "mean":
+        total = np.nansum(np.stack([left, right]), axis=0)
+        count = (~np.isnan(left)).astype("int8") + (~np.isnan(right)).astype("int8")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = np.where(count > 0, total / count, np.nan)
+        eye = np.select([has_left & has_right, has_left, has_right], ["both", "left", "right"], default=None)
+        return values, eye
+    if policy == "best_quality":
+        lq = (~np.isnan(left)).sum(axis=1) if left_quality is None else np.asarray(left_quality, dtype=dtype)
+        rq = (~np.isnan(right)).sum(axis=1) if right_quality is None else np.asarray(right_quality, dtype=dtype)
+        # Missing quality scores lose against any available eye
+        lq = np.where(has_left, np.nan_to_num(lq, nan=-np.inf), -np.inf)
+        rq = np.where(has_right, np.nan_to_num(rq, nan=-np.inf), -np.inf)
+        use_right = (rq > lq) | (has_right & ~has_left)
+        values = np.where(use_right[:, None], right, left)
+        eye = np.where(use_right, "right", np.where(has_left, "left", None))
+        return values, eye
+    raise ValueError(f"unknown eye selection policy {policy!r}; expected one of {POLICIES}")
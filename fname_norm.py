@@ -0,0 +1,44 @@
+"""
+Vectorized filename normalization shared by all AUTOMORPH scripts.
+
+Every script matches AutoMorph image rows to participants by filename, so all of
+them must agree on what a "normalized" filename is:
+- basename: path components removed (both '/' and '\\' separators), whitespace stripped
+- lower:    the stripped value lowercased (path included)
+- norm:     lowercased basename (used for full-name matching)
+- stem:     norm with a trailing extension such as '.jpg' / '.png' removed
+
+Missing values stay missing (<NA>) instead of becoming the string "nan".
+"""
+import pandas as pd
+
+try:  # Arrow-backed strings run the regex passes in C++; plain "string" works everywhere
+    import pyarrow  # noqa: F401
+    STRING_DTYPE = "string[pyarrow]"
+except ImportError:
+    STRING_DTYPE = "string"
+
+# Trailing path up to the last separator; AutoMorph exports mix Windows and POSIX paths
+_DIR_RE = r"^.*[\\/]"
+_EXT_RE = r"\.[a-z0-9]+$"
+
+
+def normalize_filenames(values):
+    """Return a DataFrame with basename, lower, norm and stem columns for `values`.
+
+    `values` is any array-like of filenames; the result shares its index.
+    """
+    s = pd.Series(values, copy=False).astype(STRING_DTYPE).str.strip()
+    basename = s.str.replace(_DIR_RE, "", regex=True)
+    lower = s.str.lower()
+    norm = basename.str.lower()
+    stem = norm.str.replace(_EXT_RE, "", regex=True)
+    return pd.DataFrame({"basename": basename, "lower": lower, "norm": norm, "stem": stem}, index=s.index)
+
+
+def add_fname_columns(df, source_col, norm_col, stem_col):
+    """Add normalized-name and stem columns for `source_col` to `df` in place."""
+    n = normalize_filenames(df[source_col])
+    df[norm_col] = n["norm"]
+    df[stem_col] = n["stem"]
+    return df
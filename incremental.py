@@ -0,0 +1,161 @@
+"""
+Incremental (delta) rebuild of the master tables after a new AutoMorph batch
+
+State from the previous run is kept in the output directory (master_incremental_state.pkl):
+- a manifest of the processed image rows: a content hash of each raw vessel row (which covers the
+  filename, hence its stem) plus the row's normalized names and eid resolution columns
+- the left/right participant feature blocks
+- the participant-table hash, eye policy, output formats, vessel column dtypes and the size/mtime of
+  the CSV outputs it wrote
+
+On the next run, vessel rows whose hash is in the manifest reuse their resolution and their lines in
+master_image_level.csv; only new or changed rows are normalized and resolved. Participants whose
+eids gain or lose image rows are re-pivoted from all of their current rows, and only their lines in
+the participant-level CSVs are re-formatted (table_io.write_table(..., reuse=...)). QC counts are
+recomputed from the patched tables. The outputs are byte-identical to a full rebuild.
+
+Any change to the participant CSV, the policy, the formats, the vessel columns or their inferred
+dtypes, or to the output files since the last run falls back to a full rebuild.
+"""
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from eid_index import file_sha256
+from qc_pipeline import RESOLVED_COLS, eye_blocks, resolve_images
+from table_io import AGGREGATED_TABLE, EYE_USED_TABLE, IMAGE_TABLE, PARTICIPANT_TABLE, table_path
+
+STATE_NAME = "master_incremental_state.pkl"
+STATE_VERSION = 1
+CSV_TABLES = (IMAGE_TABLE, PARTICIPANT_TABLE, AGGREGATED_TABLE, EYE_USED_TABLE)
+
+
+def state_path(out_dir):
+    return os.path.join(out_dir, STATE_NAME)
+
+
+def delta_config(pat_fp, policy, quality_col, formats):
+    """Settings a stored state must match to be reused."""
+    return {"pat_sha256": file_sha256(pat_fp), "policy": policy, "quality_col": quality_col, "formats": sorted(formats)}
+
+
+def vessel_signature(vessel):
+    """Raw vessel columns and inferred dtypes (a dtype change re-formats every row)."""
+    return [(c, str(dt)) for c, dt in vessel.dtypes.items()]
+
+
+def _csv_stats(out_dir):
+    stats = {}
+    for name in CSV_TABLES:
+        path = table_path(out_dir, name, "csv")
+        if os.path.exists(path):
+            st = os.stat(path)
+            stats[name] = (st.st_size, st.st_mtime_ns)
+    return stats
+
+
+def load_state(out_dir, config):
+    """The previous run's state if it was written with `config` and its outputs are untouched, else None."""
+    try:
+        with open(state_path(out_dir), "rb") as fh:
+            state = pickle.load(fh)
+    except Exception:  # missing or unreadable (e.g. pickled with another pandas): full rebuild
+        return None
+    if state.get("version") != STATE_VERSION or state.get("config") != config or state.get("files") != _csv_stats(out_dir):
+        return None
+    return state
+
+
+def save_state(out_dir, delta, vessel, feature_cols, left_block, right_block):
+    """Store the manifest and blocks of this run (call after all outputs are written)."""
+    state = {
+        "version": STATE_VERSION,
+        "config": delta["config"],
+        "signature": delta["signature"],
+        "feature_cols": feature_cols,
+        "manifest": vessel[RESOLVED_COLS].assign(row_hash=delta["row_hashes"]).reset_index(drop=True),
+        "left_block": left_block,
+        "right_block": right_block,
+        "files": _csv_stats(out_dir),
+    }
+    tmp_fp = state_path(out_dir) + ".tmp"
+    with open(tmp_fp, "wb") as fh:
+        pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fp, state_path(out_dir))
+
+
+def row_hashes(vessel):
+    """uint64 content hash of every raw vessel row."""
+    return pd.util.hash_pandas_object(vessel, index=False).to_numpy()
+
+
+def match_rows(new_hashes, old_hashes):
+    """Old position of each new row with identical content (k-th duplicate matches k-th duplicate), -1 if none."""
+    old = pd.DataFrame({"h": old_hashes, "pos": np.arange(len(old_hashes))})
+    old["k"] = old.groupby("h").cumcount()
+    new = pd.DataFrame({"h": new_hashes})
+    new["k"] = new.groupby("h").cumcount()
+    return new.merge(old, on=["h", "k"], how="left")["pos"].fillna(-1).to_numpy(dtype="int64")
+
+
+def resolve_delta(vessel, eid_index, state, config):
+    """resolve_images for a raw vessel table, resolving only rows not already in `state`.
+
+    Returns (resolved vessel, delta). delta["image_reuse"] is the old image-table row of every row
+    (-1 = re-formatted) and delta["affected_eids"] the eids whose participant rows must be rebuilt;
+    both are None when there is no usable state (full rebuild).
+    """
+    delta = {"config": config, "signature": vessel_signature(vessel), "row_hashes": row_hashes(vessel),
+             "state": state, "image_reuse": None, "affected_eids": None}
+    if state is not None and state["signature"] != delta["signature"]:
+        state = delta["state"] = None
+    if state is None:
+        delta.update(full_rebuild=True, n_reused=0, n_new=len(vessel), n_removed=0)
+        return resolve_images(vessel, eid_index), delta
+
+    manifest = state["manifest"]
+    old_pos = match_rows(delta["row_hashes"], manifest["row_hash"].to_numpy())
+    fresh = old_pos < 0
+    kept = old_pos[~fresh]
+    resolved = resolve_images(vessel.loc[fresh].copy(), eid_index)
+    reused = manifest[RESOLVED_COLS].iloc[kept].set_index(vessel.index[~fresh])
+    reused = vessel.loc[~fresh].drop(columns=RESOLVED_COLS, errors="ignore").join(reused)[resolved.columns]
+    parts = [p for p in (reused, resolved) if len(p)] or [resolved]
+    out = pd.concat(parts).sort_index().astype(manifest[RESOLVED_COLS].dtypes.to_dict())
+
+    # Participants gaining or losing rows; if surviving rows were reordered, the first image per eye
+    # may change for anyone, so every participant is rebuilt
+    removed = np.ones(len(manifest), dtype=bool)
+    removed[kept] = False
+    affected = pd.concat([resolved["eid"], manifest.loc[removed, "eid"]]).dropna().unique()
+    in_order = bool((np.diff(kept) > 0).all())
+    delta.update(image_reuse=old_pos, affected_eids=affected if in_order else None, full_rebuild=False,
+                 n_reused=len(kept), n_new=int(fresh.sum()), n_removed=int(removed.sum()))
+    return out, delta
+
+
+def pivot_delta(vessel, feature_cols, eids, delta):
+    """eye_blocks with only the affected participants re-pivoted.
+
+    Returns (left_block, right_block, participant_reuse): participant_reuse is the old
+    participant-table row of every row (-1 = re-formatted), or None after a full pivot.
+    """
+    state, affected = delta["state"], delta["affected_eids"]
+    if state is None or affected is None or state["feature_cols"] != feature_cols:
+        left_block, right_block = eye_blocks(vessel, feature_cols, eids)
+        delta["n_affected_participants"] = len(eids)
+        return left_block, right_block, None
+    rows = pd.Series(eids).isin(affected).to_numpy()
+    left_block, right_block = state["left_block"].copy(), state["right_block"].copy()
+    sub = vessel[vessel["eid"].isin(affected).to_numpy(dtype=bool, na_value=False)]
+    left_block[rows], right_block[rows] = eye_blocks(sub, feature_cols, np.asarray(eids)[rows])
+    delta["n_affected_participants"] = int(rows.sum())
+    return left_block, right_block, np.where(rows, -1, np.arange(len(rows)))
+
+
+def delta_summary(delta):
+    """JSON-friendly counts of what an incremental run reused and rebuilt."""
+    keys = ("full_rebuild", "n_reused", "n_new", "n_removed", "n_affected_participants")
+    return {k: delta.get(k) for k in keys}
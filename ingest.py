@@ -0,0 +1,146 @@
+"""
+Streaming ingestion of vessel_features_merged.csv with a declared compact schema
+
+The image table is read in chunks instead of whole:
+- features are parsed straight to float32 (no float64/object inference, no later to_numeric sweep); if a
+  column that was numeric in the sampled rows holds text further down, the stream is rerun with the
+  column types inferred per chunk and such columns are left out of the features, as in the in-memory run
+- filenames are parsed as strings, participant eids as integers
+- each chunk is normalized and resolved against the in-memory filename -> eid index, appended to the
+  image-level output, and folded into preallocated left/right participant blocks
+
+Peak memory is one chunk plus the (participants x features) blocks, independent of the image count.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from fname_norm import STRING_DTYPE
+from qc_pipeline import EXCLUDE_COLS, eye_rows, mapping_status_counts, resolve_images
+from table_io import csv_compression
+
+FILENAME_COL = "original_filename"
+DEFAULT_CHUNKSIZE = 500_000
+
+
+def vessel_schema(vessel_fp, sample_rows=10_000):
+    """Declared dtypes for the vessel CSV: filename -> string, numeric columns -> float32, rest -> string.
+
+    Numeric columns are inferred from the first `sample_rows` rows; stream_vessel falls back to
+    per-chunk inference if a column only turns non-numeric further down the file.
+    """
+    sample = pd.read_csv(vessel_fp, nrows=sample_rows, low_memory=False)
+    schema = {}
+    for c in sample.columns:
+        numeric = c != FILENAME_COL and pd.api.types.is_numeric_dtype(sample[c])
+        schema[c] = "float32" if numeric else STRING_DTYPE
+    return schema
+
+
+def read_participants(pat_fp):
+    """Participant table with integer eids and string filename columns."""
+    pat = pd.read_csv(pat_fp, low_memory=False,
+                      dtype={"left_image_filename": STRING_DTYPE, "right_image_filename": STRING_DTYPE})
+    if pd.api.types.is_float_dtype(pat["eid"]) and pat["eid"].dropna().mod(1).eq(0).all():
+        pat["eid"] = pat["eid"].astype("Int64")
+    return pat
+
+
+def stream_vessel(vessel_fp, pat, eid_index, chunksize=DEFAULT_CHUNKSIZE, schema=None, image_out_fp=None, compression=None):
+    """Stream the vessel CSV and build the left/right feature blocks incrementally.
+
+    Returns (left_block, right_block, feature_cols, stats): float32 blocks aligned to pat rows, the
+    feature column names and the image-level QC counts (same keys as qc_pipeline.image_stats).
+    If `image_out_fp` is given the resolved image-level table is appended there chunk by chunk
+    (compressed with `compression`, 'gzip'/'zstd', if given).
+    """
+    schema = schema or vessel_schema(vessel_fp)
+    feature_cols = [c for c, dt in schema.items() if dt == "float32" and c not in EXCLUDE_COLS]
+    try:
+        return _stream_vessel(vessel_fp, pat, eid_index, chunksize, schema, feature_cols, image_out_fp, compression)
+    except _Float32ParseError:
+        # A float32 column holds text past the sampled rows: infer the candidate feature columns per chunk
+        # instead, and drop the ones holding text anywhere (the in-memory run reads them as object columns)
+        if image_out_fp is not None and os.path.exists(image_out_fp):
+            os.remove(image_out_fp)  # partial image table of the first attempt
+        inferred = {c: dt for c, dt in schema.items() if dt != "float32"}
+        return _stream_vessel(vessel_fp, pat, eid_index, chunksize, inferred, feature_cols, image_out_fp, compression)
+
+
+class _Float32ParseError(ValueError):
+    """A value of a column declared float32 does not parse as a number."""
+
+
+def _read_chunks(vessel_fp, schema, chunksize):
+    """read_csv chunks with `schema`; a failed float parse raises _Float32ParseError, other errors propagate."""
+    with pd.read_csv(vessel_fp, dtype=schema, chunksize=chunksize) as reader:
+        while True:
+            try:
+                chunk = next(reader)
+            except StopIteration:
+                return
+            except pd.errors.ParserError:
+                raise  # malformed CSV, not a dtype problem
+            except ValueError as e:
+                if "float32" not in schema.values():
+                    raise
+                raise _Float32ParseError(str(e)) from e
+            yield chunk
+
+
+def _stream_vessel(vessel_fp, pat, eid_index, chunksize, schema, feature_cols, image_out_fp, compression):
+    # One block row per distinct participant; the first image seen per eid and eye wins
+    eids = pd.Index(pd.unique(pat["eid"].dropna()))
+    blocks = {eye: np.full((len(eids), len(feature_cols)), np.nan, dtype="float32") for eye in ("left", "right")}
+    filled = {eye: np.zeros(len(eids), dtype=bool) for eye in ("left", "right")}
+    mapped = np.zeros(len(eids), dtype=bool)
+    stem_hashes = []
+    n_rows = n_mapped = 0
+    status_counts = None
+    text_cols = set()
+
+    for i, chunk in enumerate(_read_chunks(vessel_fp, schema, chunksize)):
+        chunk = resolve_images(chunk, eid_index)
+        if image_out_fp is not None:
+            chunk.to_csv(image_out_fp, index=False, mode="w" if i == 0 else "a", header=i == 0,
+                         compression=csv_compression(compression))
+
+        for c in feature_cols:
+            if chunk[c].dtype != "float32":
+                # (only without a float32 schema for the column)
+                if not pd.api.types.is_numeric_dtype(chunk[c]):
+                    text_cols.add(c)
+                chunk[c] = pd.to_numeric(chunk[c], errors="coerce").astype("float32")
+
+        n_rows += len(chunk)
+        has_eid = chunk["eid"].notna()
+        n_mapped += int(has_eid.sum())
+        status_counts = mapping_status_counts(chunk, status_counts)
+        pos = eids.get_indexer(chunk.loc[has_eid, "eid"])
+        mapped[pos[pos >= 0]] = True
+        stems = chunk["orig_fname_stem"].dropna()
+        stem_hashes.append(np.unique(pd.util.hash_array(stems.to_numpy(dtype=object))))
+
+        for eye in ("left", "right"):
+            rows = eye_rows(chunk, eye, feature_cols)
+            pos = eids.get_indexer(rows["eid"])
+            new = (pos >= 0) & ~filled[eye][np.maximum(pos, 0)]
+            blocks[eye][pos[new]] = rows.loc[new, feature_cols].to_numpy(dtype="float32", na_value=np.nan)
+            filled[eye][pos[new]] = True
+
+    stats = {
+        "n_vessel_rows": n_rows,
+        "n_unique_image_filenames_in_vessel": len(np.unique(np.concatenate(stem_hashes))) if stem_hashes else 0,
+        "n_images_mapped_to_eid": n_mapped,
+        "n_unique_eids_mapped_from_images": int(mapped.sum()),
+        "mapping_status": status_counts,
+    }
+    # Expand to pat rows (repeated eids share a block row; missing eids get NaN), without text columns
+    keep = [i for i, c in enumerate(feature_cols) if c not in text_cols]
+    pos = eids.get_indexer(pat["eid"])
+    aligned = []
+    for eye in ("left", "right"):
+        block = np.vstack([blocks[eye][:, keep], np.full((1, len(keep)), np.nan, dtype="float32")])
+        aligned.append(block[pos])  # pos == -1 picks the trailing NaN row
+    return aligned[0], aligned[1], [feature_cols[i] for i in keep], stats
@@ -0,0 +1,193 @@
+"""
+Bit-packed, memory-mapped store of resized binary vessel masks for deep learning loaders
+
+Packing (once): every mask PNG is binarized (as in extract_mask_features.py), resized to the backbone
+input resolution (by default max-pooled, so thin vessels survive the downscale), bit-packed to 1 bit
+per pixel and appended to one flat array file. The store is a directory:
+
+    masks.bits    uint8 array of shape (n_masks, ceil(height * width / 8)), row i = mask i
+    index.csv     row, original_filename, orig_fname_stem, eid, matched_eye, mapping_status
+                  (eid resolution of the QC script: stem match, then full name; ambiguous -> no eid)
+    meta.json     height, width, n_masks, row_bytes, threshold, resample
+
+Reading: MaskStore memory-maps masks.bits read-only. packed() returns views of the file (no copy);
+batch() gathers random rows and unpacks them into a caller-supplied (or new) uint8 array, which is
+the only copy made. At 1 bit per pixel the store is 8x smaller than uint8 masks.
+
+Usage: python mask_store.py --masks-dir <AutoMorph masks> --pat retina_ckd_survival_ready_PAIRED.csv
+       --out M:/NEW-PROJECT/AUTOMORPH/vessel_masks_224 --size 224 224 --workers 8
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from eid_index import load_eid_index
+from extract_mask_features import Image, read_mask, vessel_mask
+from qc_pipeline import resolve_images
+
+BITS_NAME = "masks.bits"
+INDEX_NAME = "index.csv"
+META_NAME = "meta.json"
+STORE_VERSION = 1
+RESAMPLE = ("max", "nearest", "bilinear")
+DEFAULT_BATCH_SIZE = 64
+
+
+def resize_mask(mask, size, resample="max"):
+    """Resize a boolean mask to size = (height, width).
+
+    max:      a pixel is vessel if any mask pixel in its footprint is, so vessels thinner than the scale
+              factor are kept (at least 1 px wide, i.e. slightly thicker than in the full-size mask)
+    nearest:  one mask pixel per output pixel; thin vessels break up into dashes
+    bilinear: resampled, then re-thresholded at 0.5; smooth edges, but vessels thinner than about half
+              the scale factor disappear, which at backbone resolution is most of a retinal vessel tree
+    """
+    height, width = size
+    if mask.shape == (height, width):
+        return mask
+    rows = (np.arange(height) * mask.shape[0] // height)
+    cols = (np.arange(width) * mask.shape[1] // width)
+    if resample == "max":
+        # footprints rows[i]:rows[i + 1] (upsampling repeats a pixel, the same as nearest)
+        return np.logical_or.reduceat(np.logical_or.reduceat(mask, rows, axis=0), cols, axis=1)
+    if resample == "nearest":
+        return mask[rows[:, None], cols]
+    im = Image.fromarray(mask.astype(np.uint8) * 255).resize((width, height), Image.BILINEAR)
+    return np.asarray(im) >= 128
+
+
+def pack_batch(paths, size, threshold=0.5, resample="max"):
+    """(packed rows (k, row_bytes) uint8, basenames of the k packed masks, [(path, error)] unreadable)."""
+    height, width = size
+    packed = np.zeros((len(paths), (height * width + 7) // 8), dtype=np.uint8)
+    names, failed = [], []
+    for path in paths:
+        try:
+            mask = resize_mask(vessel_mask(read_mask(path), threshold), size, resample)
+        except ImportError:
+            raise
+        except Exception as e:  # corrupt / unsupported image: left out of the store
+            failed.append((path, f"{type(e).__name__}: {e}"))
+            continue
+        packed[len(names)] = np.packbits(mask.reshape(-1))
+        names.append(os.path.basename(path))
+    return packed[:len(names)], names, failed
+
+
+def pack_masks(paths, out_dir, size, eid_index, workers=1, batch_size=DEFAULT_BATCH_SIZE, threshold=0.5,
+               resample="max"):
+    """Build a store in out_dir from mask `paths` (packed in path order); returns (n_masks, failed)."""
+    if Image is None:
+        raise ImportError("reading mask PNGs requires Pillow (pip install pillow)")
+    os.makedirs(out_dir, exist_ok=True)
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    args = (batches, repeat(tuple(size)), repeat(threshold), repeat(resample))
+    results = pool.map(pack_batch, *args) if pool else map(pack_batch, *args)
+    names, failed = [], []
+    try:
+        with open(os.path.join(out_dir, BITS_NAME), "wb") as fh:
+            for packed, batch_names, batch_failed in results:
+                fh.write(packed.tobytes())
+                names.extend(batch_names)
+                failed.extend(batch_failed)
+    finally:
+        if pool:
+            pool.shutdown()
+
+    # Index rows with the QC script's filename -> eid resolution
+    resolved = resolve_images(pd.DataFrame({"original_filename": names}), eid_index)
+    index = resolved[["original_filename", "orig_fname_stem", "eid", "matched_eye", "mapping_status"]]
+    index.insert(0, "row", np.arange(len(index)))
+    index.to_csv(os.path.join(out_dir, INDEX_NAME), index=False)
+    meta = {"version": STORE_VERSION, "height": size[0], "width": size[1], "n_masks": len(names),
+            "row_bytes": (size[0] * size[1] + 7) // 8, "threshold": threshold, "resample": resample}
+    with open(os.path.join(out_dir, META_NAME), "w") as fh:
+        json.dump(meta, fh, indent=2)
+    return len(names), failed
+
+
+class MaskStore:
+    """Read-only, memory-mapped access to a packed mask store."""
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, META_NAME)) as fh:
+            self.meta = json.load(fh)
+        if self.meta.get("version") != STORE_VERSION:
+            raise ValueError(f"{store_dir}: unsupported mask store version {self.meta.get('version')}")
+        self.shape = (self.meta["height"], self.meta["width"])
+        self.index = pd.read_csv(os.path.join(store_dir, INDEX_NAME), dtype={"eid": "Int64"})
+        n, row_bytes = self.meta["n_masks"], self.meta["row_bytes"]
+        self.bits = (np.memmap(os.path.join(store_dir, BITS_NAME), dtype=np.uint8, mode="r", shape=(n, row_bytes))
+                     if n else np.zeros((0, row_bytes), dtype=np.uint8))
+
+    def __len__(self):
+        return self.meta["n_masks"]
+
+    def __getitem__(self, row):
+        return self.batch([row])[0]
+
+    def rows(self, eids=None, eye=None, stems=None):
+        """Store rows matching all given filters: eids (list), eye ('left'/'right'; 'both' images match
+        either) and normalized filename stems (list)."""
+        sel = np.ones(len(self.index), dtype=bool)
+        if eids is not None:
+            sel &= self.index["eid"].isin(list(eids)).to_numpy(dtype=bool, na_value=False)
+        if eye is not None:
+            sel &= self.index["matched_eye"].isin([eye, "both"]).to_numpy()
+        if stems is not None:
+            sel &= self.index["orig_fname_stem"].isin(list(stems)).to_numpy()
+        return self.index["row"].to_numpy()[sel]
+
+    def packed(self, start, stop):
+        """Packed rows start..stop as a view of the memory-mapped file (no copy)."""
+        return self.bits[start:stop]
+
+    def batch(self, rows, out=None):
+        """Masks of `rows` (any order, repeats allowed) unpacked to uint8 0/1, shape (len(rows), height, width).
+
+        Pass a preallocated `out` of that shape and dtype uint8 to reuse one buffer across batches.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        n_pixels = self.shape[0] * self.shape[1]
+        unpacked = np.unpackbits(self.bits[rows], axis=1, count=n_pixels)
+        if out is None:
+            return unpacked.reshape(len(rows), *self.shape)
+        out.reshape(len(rows), n_pixels)[...] = unpacked
+        return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--masks-dir", required=True, help="directory with AutoMorph vessel masks / probability maps")
+    ap.add_argument("--pattern", default="*.png", help="glob for mask files inside --masks-dir")
+    ap.add_argument("--pat", required=True, help="participant CSV used for eid resolution (retina_ckd_survival_ready_PAIRED.csv)")
+    ap.add_argument("--out", required=True, help="store directory")
+    ap.add_argument("--size", nargs=2, type=int, default=[224, 224], metavar=("HEIGHT", "WIDTH"))
+    ap.add_argument("--resample", choices=RESAMPLE, default="max",
+                    help="max keeps vessels thinner than the scale factor; bilinear drops them (see resize_mask)")
+    ap.add_argument("--threshold", type=float, default=0.5, help="binarization threshold as a fraction of full intensity")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="images read per task")
+    args = ap.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.masks_dir, args.pattern)))
+    n, failed = pack_masks(paths, args.out, args.size, load_eid_index(args.pat), args.workers, args.batch_size,
+                           args.threshold, args.resample)
+    row_bytes = (args.size[0] * args.size[1] + 7) // 8
+    print(f"Packed {n} masks of {args.size[0]}x{args.size[1]} into {args.out} ({n * row_bytes / 1e6:.1f} MB)")
+    if failed:
+        print(f"{len(failed)} images could not be read:", file=sys.stderr)
+        for path, err in failed:
+            print(f"  {path}: {err}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+In-process API of the image/participant QC pipeline
+
+    from pipeline import run_qc_pipeline
+    out = run_qc_pipeline(vessel_df_or_path, pat_df_or_path)
+    out["aggregated"], out["qc"]
+
+Runs the same stages as "Creating new image and participant level QC.py" (in-memory mode) and
+returns the tables, so notebooks, the synthetic demo and benchmarks need neither a subprocess nor
+the M:/ paths. Inputs may be DataFrames (not modified; the filename -> eid index is built from
+`pat`) or CSV paths (the index is cached next to the participant CSV; both CSVs are read
+concurrently). Outputs are written only when output_dir is given, qc_report.txt included, from a
+thread pool and optionally compressed (table_io.write_tables).
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from cv_folds import DEFAULT_FOLDS, FOLDS_TABLE, fold_index
+from eid_index import build_eid_index, load_eid_index
+from qc_pipeline import aggregated_table, build_master_tables, feature_columns, normalize_participants, qc_counts
+from sharded import build_participant_sharded, eye_blocks_sharded, resolve_images_sharded, shard_pool
+from table_io import (AGGREGATED_TABLE, DEFAULT_IO_THREADS, EYE_USED_TABLE, IMAGE_TABLE, PARTICIPANT_TABLE,
+                      atomic_output, write_tables)
+
+QC_REPORT_NAME = "qc_report.txt"
+
+
+def write_qc_report(qc, out_dir):
+    """Write the QC counts as `key: value` lines to out_dir/qc_report.txt; returns the path."""
+    path = os.path.join(out_dir, QC_REPORT_NAME)
+    with atomic_output(path) as tmp, open(tmp, "w") as fh:
+        for k, v in qc.items():
+            fh.write(f"{k}: {v}\n")
+    return path
+
+
+def write_outputs(tables, out_dir, formats=("csv",), compression=None, io_threads=DEFAULT_IO_THREADS, log=None):
+    """Write the four master tables, the CV fold index (if any) and qc_report.txt as the main script does.
+
+    compression: 'gzip'/'zstd' for the CSVs. log: optional list receiving per-file bytes/seconds.
+    Returns {table name: {format: path}} plus "qc_report": path.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    common = dict(out_dir=out_dir, formats=formats, compression=compression)
+    eye_used = tables["participant"]["eye_used"]
+    jobs = [dict(df=tables["image"], name=IMAGE_TABLE, **common)]
+    for name, key in ((PARTICIPANT_TABLE, "participant"), (AGGREGATED_TABLE, "aggregated"), (EYE_USED_TABLE, "eye_used")):
+        jobs.append(dict(df=tables[key], name=name, partition=eye_used, **common))
+    if tables.get("folds") is not None:
+        jobs.append(dict(df=tables["folds"], name=FOLDS_TABLE, **common))
+    saved = write_tables(jobs, io_threads, log)
+    saved["qc_report"] = write_qc_report(tables["qc"], out_dir)
+    return saved
+
+
+def _sharded_tables(vessel, pat, eid_index, policy, quality_col, workers):
+    normalize_participants(pat)
+    with shard_pool(workers, eid_index) as pool:
+        vessel, stats = resolve_images_sharded(pool, vessel, eid_index, workers)
+        feature_cols = feature_columns(vessel)
+        left_block, right_block = eye_blocks_sharded(pool, vessel, feature_cols, pat["eid"], workers)
+        participant = build_participant_sharded(pool, pat, left_block, right_block, feature_cols, policy, quality_col,
+                                                n_shards=workers)
+    return {
+        "image": vessel,
+        "participant": participant,
+        "aggregated": aggregated_table(participant, left_block, feature_cols),
+        "feature_cols": feature_cols,
+        "qc": qc_counts(stats, pat, participant),
+    }
+
+
+def read_inputs(vessel, pat, eid_index):
+    """Read the path inputs (and the cached eid index) concurrently; DataFrames are copied."""
+    def read(src):
+        return pd.read_csv(src, low_memory=False) if isinstance(src, (str, os.PathLike)) else src.copy()
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        vessel = pool.submit(read, vessel)
+        if eid_index is None:
+            eid_index = load_eid_index(pat) if isinstance(pat, (str, os.PathLike)) else build_eid_index(pat)
+        pat = read(pat)
+        return vessel.result(), pat, eid_index
+
+
+def run_qc_pipeline(vessel, pat, eid_index=None, policy="left_first", quality_col=None, output_dir=None,
+                    formats=("csv",), workers=1, cv_folds=DEFAULT_FOLDS, cv_seed=0, cv_stratify=(), parse_ukb=False,
+                    compression=None, io_threads=DEFAULT_IO_THREADS):
+    """Build the master tables in memory.
+
+    vessel / pat: DataFrames or CSV paths. eid_index: optional prebuilt index (eid_index.py).
+    workers > 1 runs the stages in a process pool (see sharded.py; guard the caller's entry point).
+    cv_folds / cv_seed / cv_stratify: participant-grouped fold index (cv_folds.py; 0 = none).
+    parse_ukb: eid/eye from UK Biobank filenames where possible (eid_index.resolve_eids_ukb; serial only).
+    compression / io_threads: CSV compression and writer threads of the outputs (see write_outputs).
+    Returns a dict with "image", "participant", "aggregated", "eye_used", "folds", "feature_cols", "qc"
+    and "saved" (see write_outputs; empty when output_dir is None).
+    """
+    if parse_ukb and workers > 1:
+        raise ValueError("parse_ukb is only supported with workers=1")
+    vessel, pat, eid_index = read_inputs(vessel, pat, eid_index)
+
+    if workers > 1:
+        tables = _sharded_tables(vessel, pat, eid_index, policy, quality_col, workers)
+    else:
+        tables = build_master_tables(vessel, pat, eid_index, policy, quality_col, parse_ukb)
+    tables["eye_used"] = tables["participant"][["eid", "eye_used"]]
+    tables["folds"] = fold_index(tables["participant"], cv_folds, cv_seed, cv_stratify) if cv_folds else None
+    tables["saved"] = (write_outputs(tables, output_dir, formats, compression, io_threads)
+                       if output_dir is not None else {})
+    return tables
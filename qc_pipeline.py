@@ -0,0 +1,201 @@
+"""
+Stage functions of the image/participant QC pipeline
+
+"Creating new image and participant level QC.py" runs these stages in order:
+normalize filenames -> resolve eids -> pivot left/right feature blocks -> eye selection -> QC counts.
+They are kept here so other scripts (streaming ingestion, exporters, benchmarks) run exactly the
+same logic.
+"""
+import numpy as np
+import pandas as pd
+
+from eid_index import MAPPING_STATUSES, resolve_eids, resolve_eids_ukb
+from eye_selection import feature_block, select_eye
+from fname_norm import add_fname_columns
+
+# Mapping/meta columns that are never treated as image features
+EXCLUDE_COLS = {"original_filename", "orig_fname_norm", "orig_fname_stem", "matched_eid_stem", "matched_eid_full", "eid",
+                "matched_eye", "mapping_status", "n_candidate_eids", "ukb_instance", "ukb_array", "filename_conflict",
+                "filename_unlisted"}
+# Columns added to the image table by normalization and eid resolution, in resolve_images order
+RESOLVED_COLS = ["orig_fname_norm", "orig_fname_stem", "matched_eid_stem", "matched_eid_full", "eid", "matched_eye",
+                 "mapping_status", "n_candidate_eids"]
+
+
+def normalize_participants(pat):
+    """Add left/right normalized filename and stem columns to the participant table (in place)."""
+    add_fname_columns(pat, "left_image_filename", "left_fname_norm", "left_fname_stem")
+    add_fname_columns(pat, "right_image_filename", "right_fname_norm", "right_fname_stem")
+    return pat
+
+
+def normalize_images(vessel):
+    """Add normalized filename and stem columns to the image table (in place)."""
+    add_fname_columns(vessel, "original_filename", "orig_fname_norm", "orig_fname_stem")
+    return vessel
+
+
+def attach_eids(vessel, eid_index, parse_ukb=False):
+    """Attach eid, eye side and mapping status to every row of a normalized image table.
+
+    parse_ukb: take eid/eye from UK Biobank filenames where possible (eid_index.resolve_eids_ukb).
+    """
+    resolve = resolve_eids_ukb if parse_ukb else resolve_eids
+    resolved = resolve(vessel["orig_fname_stem"], vessel["orig_fname_norm"], eid_index)
+    return vessel.drop(columns=resolved.columns, errors="ignore").join(resolved)
+
+
+def resolve_images(vessel, eid_index, parse_ukb=False):
+    """Normalize image filenames and attach eid, eye side and mapping status to every image row."""
+    return attach_eids(normalize_images(vessel), eid_index, parse_ukb)
+
+
+def feature_columns(vessel):
+    """Numeric image feature columns (mapping/meta columns excluded)."""
+    numeric_cols = vessel.select_dtypes(include=[np.number]).columns.tolist()
+    return [c for c in numeric_cols if c not in EXCLUDE_COLS]
+
+
+def eye_rows(vessel, eye, feature_cols):
+    """One matched image row per eid for `eye` ('left'/'right'); images listed as both eyes count for each.
+
+    The first row per eid is used. If UK Biobank instances were parsed (ukb_instance column), images
+    the participant table lists come first (filename_unlisted False), so a parsed unlisted image only
+    fills an eye without a listed one; among those, the row with the lowest (instance, array index)
+    is used, i.e. the baseline visit, and rows without a parsed instance come last, in row order.
+    """
+    sel = vessel["eid"].notna() & vessel["matched_eye"].isin([eye, "both"])
+    if "ukb_instance" not in vessel.columns:
+        return vessel.loc[sel, ["eid"] + feature_cols].drop_duplicates(subset=["eid"])
+    rows = vessel.loc[sel, ["eid", "ukb_instance", "ukb_array"] + feature_cols]
+    unlisted = (vessel.loc[sel, "filename_unlisted"].to_numpy(dtype=bool) if "filename_unlisted" in vessel.columns
+                else np.zeros(len(rows), dtype=bool))
+    na_rank = np.iinfo("int64").max
+    rank = (rows["ukb_instance"].to_numpy(dtype="float64", na_value=np.nan) * (1 << 20)
+            + rows["ukb_array"].to_numpy(dtype="float64", na_value=np.nan))
+    rank = np.where(np.isnan(rank), na_rank, rank)
+    # Stable sort by (listed first, rank), then the first row per eid (ties keep row order)
+    order = np.lexsort((rank, unlisted))
+    pos = np.sort(order[~rows["eid"].iloc[order].duplicated().to_numpy()])
+    return rows.iloc[pos][["eid"] + feature_cols]
+
+
+def eye_blocks(vessel, feature_cols, eids):
+    """Left and right feature blocks aligned to `eids` (NaN rows where a participant has no image)."""
+    blocks = []
+    for eye in ("left", "right"):
+        rows = eye_rows(vessel, eye, feature_cols).set_index("eid")
+        blocks.append(feature_block(rows.reindex(np.asarray(eids)), feature_cols))
+    return blocks
+
+
+def build_participant(pat, left_block, right_block, feature_cols, policy="left_first", quality_col=None):
+    """Participant table: pat columns, left_/right_ features, QC flags, eye_used and combined features."""
+    has_left = ~np.isnan(left_block).all(axis=1)
+    has_right = ~np.isnan(right_block).all(axis=1)
+
+    # Combined single-image features with the configured policy (default: prefer left, otherwise right)
+    quality = (None, None)
+    if quality_col is not None:
+        q = feature_cols.index(quality_col)
+        quality = (left_block[:, q], right_block[:, q])
+    combined_block, eye_used = select_eye(left_block, right_block, policy, *quality)
+
+    # One concat instead of inserting columns one by one (base feature names overwrite same-named pat columns)
+    idx = pat.index
+    return pd.concat([
+        pat.drop(columns=[f for f in feature_cols if f in pat.columns]),
+        pd.DataFrame(left_block, columns=[f"left_{c}" for c in feature_cols], index=idx),
+        pd.DataFrame(right_block, columns=[f"right_{c}" for c in feature_cols], index=idx),
+        pd.DataFrame({
+            "has_left_features": has_left,
+            "has_right_features": has_right,
+            "num_images_with_features": has_left.astype(int) + has_right.astype(int),
+            # number of images with left-eye features specifically (useful for QC/selection)
+            "num_images_with_left_eye_features": has_left.astype(int),
+            "eye_used": pd.Series(eye_used, index=idx, dtype=object),
+        }, index=idx),
+        pd.DataFrame(combined_block, columns=feature_cols, index=idx),
+        # Also create simple flags for QC
+        pd.DataFrame({"used_left": eye_used == "left", "used_right": eye_used == "right"}, index=idx),
+    ], axis=1)
+
+
+def aggregated_table(participant, left_block, feature_cols):
+    """eid, left-eye QC flags and base feature names taken from the left-eye block (left eye only)."""
+    return pd.concat([
+        participant[["eid", "num_images_with_left_eye_features", "has_left_features"]],
+        pd.DataFrame(left_block, columns=feature_cols, index=participant.index),
+    ], axis=1)
+
+
+def mapping_status_counts(vessel, counts=None):
+    """Image rows per mapping_status, plus rows whose filename is listed for several eids ("ambiguous").
+
+    Pass the `counts` of earlier chunks to accumulate over a streamed table.
+    """
+    counts = dict(counts or dict.fromkeys(MAPPING_STATUSES + ("ambiguous",), 0))
+    for status, n in vessel["mapping_status"].value_counts().items():
+        counts[status] += int(n)
+    counts["ambiguous"] += int((vessel["n_candidate_eids"] > 1).sum())
+    return counts
+
+
+def image_stats(vessel):
+    """Image-level QC counts for a resolved vessel table."""
+    stats = {
+        "n_vessel_rows": len(vessel),
+        "n_unique_image_filenames_in_vessel": int(vessel["orig_fname_stem"].nunique()),
+        "n_images_mapped_to_eid": int(vessel["eid"].notna().sum()),
+        "n_unique_eids_mapped_from_images": int(vessel["eid"].dropna().nunique()),
+        "mapping_status": mapping_status_counts(vessel),
+    }
+    if "filename_conflict" in vessel.columns:
+        stats["n_filename_join_disagreements"] = int((vessel["filename_conflict"] | vessel["filename_unlisted"]).sum())
+        # participants whose selected left or right image is one the participant table does not list
+        selected = [eye_rows(vessel, eye, ["filename_unlisted"]) for eye in ("left", "right")]
+        unlisted = pd.concat(selected).query("filename_unlisted")["eid"]
+        stats["n_participants_using_unlisted_image"] = int(unlisted.nunique())
+    return stats
+
+
+def qc_counts(stats, pat, participant):
+    """Basic QC report counts (image-level `stats` from image_stats or streaming ingestion)."""
+    qc = {}
+    qc["n_vessel_rows"] = stats["n_vessel_rows"]
+    qc["n_unique_image_filenames_in_vessel"] = stats["n_unique_image_filenames_in_vessel"]
+    qc["n_pat_rows"] = len(pat)
+    qc["n_left_fnames_nonmissing"] = int(pat["left_fname_stem"].notna().sum())
+    # Right-eye counts removed intentionally; pipeline uses left eye only
+    qc["n_images_mapped_to_eid"] = stats["n_images_mapped_to_eid"]
+    qc["n_unique_eids_mapped_from_images"] = stats["n_unique_eids_mapped_from_images"]
+    qc["n_participants_with_left_eye_features"] = int(participant["has_left_features"].sum())
+    qc["n_participants_with_right_eye_features"] = int(participant["has_right_features"].sum())
+    qc["n_participants_used_left"] = int(participant['used_left'].sum())
+    qc["n_participants_used_right"] = int(participant['used_right'].sum())
+    if "n_filename_join_disagreements" in stats:
+        # images whose UK Biobank filename names another eid/eye than the participant table (join result kept)
+        # or is not listed there (parsed eid/eye used), and participants whose selected image is such a file
+        qc["n_filename_join_disagreements"] = stats["n_filename_join_disagreements"]
+        qc["n_participants_using_unlisted_image"] = stats["n_participants_using_unlisted_image"]
+    return qc
+
+
+def build_master_tables(vessel, pat, eid_index, policy="left_first", quality_col=None, parse_ukb=False):
+    """Run normalization, eid resolution, pivot, eye selection and QC counts in memory.
+
+    `pat` gains its normalized filename columns in place. Returns a dict with the resolved image
+    table ("image"), "participant", "aggregated", "feature_cols" and the "qc" counts.
+    """
+    normalize_participants(pat)
+    vessel = resolve_images(vessel, eid_index, parse_ukb)
+    feature_cols = feature_columns(vessel)
+    left_block, right_block = eye_blocks(vessel, feature_cols, pat["eid"])
+    participant = build_participant(pat, left_block, right_block, feature_cols, policy, quality_col)
+    return {
+        "image": vessel,
+        "participant": participant,
+        "aggregated": aggregated_table(participant, left_block, feature_cols),
+        "feature_cols": feature_cols,
+        "qc": qc_counts(image_stats(vessel), pat, participant),
+    }
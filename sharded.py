@@ -0,0 +1,117 @@
+"""
+Multi-process (sharded) execution of the in-memory QC pipeline stages
+
+Three passes over a process pool, each merged back deterministically (pool.map keeps task order):
+1. normalization + eid resolution: image rows in contiguous ranges (every row resolves on its own,
+   so ranges merge back by concatenation); each range also returns its QC counters
+2. left/right pivot: participants and their matched image rows hash-partitioned by eid, so every
+   eid's rows stay together in their original order (the first image per eye wins as in serial mode);
+   shard blocks are scattered back to the participant rows
+3. eye selection: participant rows in contiguous ranges (selection is per row)
+
+The results are identical to the serial functions in qc_pipeline.py. The eid index is sent to every
+worker once (pool initializer). The calling script must guard its entry point with
+`if __name__ == "__main__":`, because Windows starts workers by re-importing it.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from cv_folds import eid_hashes
+from qc_pipeline import (RESOLVED_COLS, build_participant, eye_blocks, image_stats, mapping_status_counts,
+                         resolve_images)
+
+_EID_INDEX = None
+
+
+def _init_worker(eid_index):
+    global _EID_INDEX
+    _EID_INDEX = eid_index
+
+
+def shard_pool(workers, eid_index):
+    """Process pool whose workers hold the filename -> eid index."""
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(eid_index,))
+
+
+def eid_shards(eids, n_shards):
+    """Shard number (0..n_shards-1) of every eid; stable across processes, runs and eid dtypes
+    (numeric eids hashed as numbers, others by their string value; see cv_folds.eid_hashes)."""
+    return (eid_hashes(eids) % np.uint64(n_shards)).astype("int64")
+
+
+def _row_ranges(n_rows, n_shards):
+    return [r for r in np.array_split(np.arange(n_rows), n_shards) if len(r)]
+
+
+def _resolve_shard(filenames):
+    part = resolve_images(filenames.to_frame(), _EID_INDEX)
+    stems = part["orig_fname_stem"].dropna().to_numpy(dtype=object)
+    counters = {
+        "n_vessel_rows": len(part),
+        "n_images_mapped_to_eid": int(part["eid"].notna().sum()),
+        "mapping_status": mapping_status_counts(part),
+        "stem_hashes": np.unique(pd.util.hash_array(stems)),
+        "eids": part["eid"].dropna().drop_duplicates(),
+    }
+    return part[RESOLVED_COLS], counters
+
+
+def resolve_images_sharded(pool, vessel, eid_index, n_shards):
+    """resolve_images + image_stats with the image rows split over the pool; returns (vessel, stats)."""
+    ranges = _row_ranges(len(vessel), n_shards)
+    if not ranges:
+        vessel = resolve_images(vessel, eid_index)
+        return vessel, image_stats(vessel)
+    filenames = vessel["original_filename"]
+    results = list(pool.map(_resolve_shard, [filenames.iloc[r] for r in ranges]))
+    resolved = pd.concat([part for part, _ in results])
+
+    # Same columns and order as resolve_images: normalized names assigned, resolution columns re-joined
+    vessel = vessel.copy()
+    for col in RESOLVED_COLS[:2]:
+        vessel[col] = resolved[col]
+    vessel = vessel.drop(columns=RESOLVED_COLS[2:], errors="ignore").join(resolved[RESOLVED_COLS[2:]])
+
+    counters = [c for _, c in results]
+    status = None
+    for c in counters:
+        status = {k: status[k] + n for k, n in c["mapping_status"].items()} if status else dict(c["mapping_status"])
+    stats = {
+        "n_vessel_rows": sum(c["n_vessel_rows"] for c in counters),
+        "n_unique_image_filenames_in_vessel": len(np.unique(np.concatenate([c["stem_hashes"] for c in counters]))),
+        "n_images_mapped_to_eid": sum(c["n_images_mapped_to_eid"] for c in counters),
+        "n_unique_eids_mapped_from_images": int(pd.concat([c["eids"] for c in counters]).nunique()),
+        "mapping_status": status,
+    }
+    return vessel, stats
+
+
+def eye_blocks_sharded(pool, vessel, feature_cols, eids, n_shards):
+    """eye_blocks with participants and their image rows hash-partitioned by eid over the pool."""
+    eids = np.asarray(eids)
+    mapped = vessel.loc[vessel["eid"].notna().to_numpy(), ["eid", "matched_eye"] + feature_cols]
+    pat_shard = eid_shards(eids, n_shards)
+    row_shard = eid_shards(mapped["eid"], n_shards)
+    shards = range(n_shards)
+    results = pool.map(eye_blocks, [mapped[row_shard == k] for k in shards], repeat(feature_cols),
+                       [eids[pat_shard == k] for k in shards])
+    left_block = np.full((len(eids), len(feature_cols)), np.nan)
+    right_block = np.full((len(eids), len(feature_cols)), np.nan)
+    for k, (left, right) in zip(shards, results):
+        left_block[pat_shard == k] = left
+        right_block[pat_shard == k] = right
+    return left_block, right_block
+
+
+def build_participant_sharded(pool, pat, left_block, right_block, feature_cols, policy="left_first", quality_col=None,
+                              n_shards=1):
+    """build_participant over contiguous participant row ranges in the pool, concatenated in order."""
+    ranges = _row_ranges(len(pat), n_shards)
+    if not ranges:
+        return build_participant(pat, left_block, right_block, feature_cols, policy, quality_col)
+    parts = pool.map(build_participant, [pat.iloc[r] for r in ranges], [left_block[r] for r in ranges],
+                     [right_block[r] for r in ranges], repeat(feature_cols), repeat(policy), repeat(quality_col))
+    return pd.concat(list(parts))
@@ -0,0 +1,87 @@
+"""
+Per-stage instrumentation for the QC pipeline scripts
+
+    prof = StageProfiler(enabled=args.profile)
+    with prof.stage("load") as st:
+        vessel = pd.read_csv(...)
+        st["rows_out"] = len(vessel)
+    prof.write_json(os.path.join(OUTPUT_DIR, METRICS_NAME), qc=qc)
+
+Each stage records wall time, rows in/out (filled in by the caller) and the process RSS after the
+stage (current and peak). When disabled, stage() yields a throwaway dict and records nothing, so
+the instrumented code runs unchanged apart from one context-manager call per stage.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRICS_NAME = "pipeline_metrics.json"
+
+
+def peak_rss_mb():
+    """Process peak resident set size in MB (None where the resource module is unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+def current_rss_mb():
+    """Current resident set size in MB from /proc (None on other platforms)."""
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / (1 << 20), 1)
+
+
+class StageProfiler:
+    """Collects one record per pipeline stage and writes them as JSON."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        if not self.enabled:
+            yield {}
+            return
+        rec = {"stage": name, "rows_in": rows_in, "rows_out": None}
+        start = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec["seconds"] = round(time.perf_counter() - start, 4)
+            rec["rss_mb"] = current_rss_mb()
+            rec["peak_rss_mb"] = peak_rss_mb()
+            self.stages.append(rec)
+
+    def report(self, **sections):
+        """{"total_seconds", "peak_rss_mb", "stages": [...], **sections}."""
+        return {"total_seconds": round(time.perf_counter() - self._start, 4), "peak_rss_mb": peak_rss_mb(),
+                "stages": self.stages, **sections}
+
+    def write_json(self, path, **sections):
+        """Write report(**sections) to `path` (no-op when disabled); returns the path or None."""
+        if not self.enabled:
+            return None
+        with open(path, "w") as fh:
+            json.dump(self.report(**sections), fh, indent=2, default=_json_default)
+        return path
+
+
+def _json_default(value):
+    # numpy scalars and pandas NA in counts / row numbers
+    if hasattr(value, "item"):
+        return value.item()
+    return None if value is None or value != value else str(value)
@@ -0,0 +1,129 @@
+"""
+Synthetic AUTOMORPH inputs: the fixed 6-participant demo and scalable realistic cohorts
+
+make_cohort / write_cohort produce vessel_features_merged.csv / retina_ckd_survival_ready_PAIRED.csv
+look-alikes with the awkward cases seen in the real data:
+- participants missing one or both eye images, and listed images without AutoMorph output
+- repeat-visit instances (_1_0) and mixed / upper-case extensions (.jpg, .JPG, .png, .jpeg)
+- vessel filenames with POSIX or Windows directory prefixes and stray whitespace
+- duplicate vessel rows, filenames listed by two participants (ambiguous) and orphan images
+- any number of float32 feature columns (the twelve parameters of extract_mask_features.py
+  first, then feat_NNN)
+
+Everything is generated with NumPy/pandas vector operations; write_cohort works in participant
+blocks so 10M-image cohorts never need to fit in memory at once.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from extract_mask_features import FEATURES as AUTOMORPH_FEATURES
+
+LEFT_FIELD, RIGHT_FIELD = 21015, 21016
+START_EID = 1_000_000
+# Expected vessel rows per participant with the default rates (used to size cohorts)
+IMAGES_PER_PARTICIPANT = 1.75
+
+
+def demo_cohort():
+    """The fixed 6-participant / 8-image demo used by synthetic_demo.py."""
+    pat = pd.DataFrame({
+        'eid': [1001, 1002, 1003, 1004, 1005, 1006],
+        'left_image_filename': ['1001_21015_0_0.jpg', '1002_21015_0_0.jpg', pd.NA, '1004_21015_0_0.jpg', '1005_21015_0_0.jpg', pd.NA],
+        'right_image_filename': [pd.NA, '1002_21016_0_0.jpg', '1003_21016_0_0.jpg', '1004_21016_0_0.jpg', pd.NA, '1006_21016_0_0.jpg']
+    })
+    vessel = pd.DataFrame([
+        # image for 1001 left
+        {'original_filename': '1001_21015_0_0.jpg', 'height': 100, 'width': 120, 'area_px': 1200, 'vessel_density': 0.32},
+        # 1002 left and right
+        {'original_filename': '1002_21015_0_0.jpg', 'height': 98, 'width': 118, 'area_px': 1156, 'vessel_density': 0.30},
+        {'original_filename': '1002_21016_0_0.jpg', 'height': 101, 'width': 119, 'area_px': 1201, 'vessel_density': 0.33},
+        # 1003 only right
+        {'original_filename': '1003_21016_0_0.jpg', 'height': 95, 'width': 110, 'area_px': 1045, 'vessel_density': 0.28},
+        # 1004 both
+        {'original_filename': '1004_21015_0_0.jpg', 'height': 102, 'width': 125, 'area_px': 1275, 'vessel_density': 0.35},
+        {'original_filename': '1004_21016_0_0.jpg', 'height': 103, 'width': 126, 'area_px': 1298, 'vessel_density': 0.36},
+        # 1005 left only
+        {'original_filename': '1005_21015_0_0.jpg', 'height': 99, 'width': 115, 'area_px': 1138, 'vessel_density': 0.31},
+        # 1006 right only
+        {'original_filename': '1006_21016_0_0.jpg', 'height': 100, 'width': 120, 'area_px': 1200, 'vessel_density': 0.29},
+    ])
+    return vessel, pat
+
+
+def feature_names(n_features):
+    extra = [f"feat_{i:03d}" for i in range(len(AUTOMORPH_FEATURES) + 1, n_features + 1)]
+    return (AUTOMORPH_FEATURES + extra)[:n_features]
+
+
+def _filenames(eids, field, instance, ext):
+    return (pd.Series(eids.astype(str)) + f"_{field}_" + pd.Series(instance.astype(str)) + "_0" + pd.Series(ext)).to_numpy(dtype=object)
+
+
+def make_cohort(n_participants, n_features=12, seed=0, start_eid=START_EID, missing_eye_rate=0.15,
+                missing_image_rate=0.05, repeat_visit_rate=0.1, duplicate_rate=0.01, ambiguous_rate=0.002,
+                orphan_rate=0.01, path_prefix_rate=0.2):
+    """Generate (vessel, pat) DataFrames for `n_participants` consecutive eids starting at `start_eid`."""
+    rng = np.random.default_rng(seed)
+    n = n_participants
+    eids = np.arange(start_eid, start_eid + n, dtype="int64")
+
+    # Participant table: one listed image per eye, some eyes missing, some repeat-visit instances
+    instance = (rng.random(n) < repeat_visit_rate).astype(int)
+    pat_ext = rng.choice([".jpg", ".png"], size=n, p=[0.9, 0.1])
+    left = _filenames(eids, LEFT_FIELD, instance, pat_ext)
+    right = _filenames(eids, RIGHT_FIELD, instance, pat_ext)
+    missing = rng.random(n)
+    left[missing < missing_eye_rate / 2] = None
+    right[(missing >= missing_eye_rate / 2) & (missing < missing_eye_rate)] = None
+    # Ambiguous: a participant's right image is also listed as another participant's left image
+    amb = np.flatnonzero(rng.random(n) < ambiguous_rate)
+    if len(amb) and n > 1:
+        right[amb] = left[(amb + 1) % n]
+    pat = pd.DataFrame({"eid": eids, "left_image_filename": left, "right_image_filename": right,
+                        "age": rng.integers(40, 71, size=n), "sex": rng.integers(0, 2, size=n),
+                        "egfr": rng.normal(85, 15, size=n).round(1), "esrd_event": (rng.random(n) < 0.02).astype(int)})
+
+    # Vessel table: AutoMorph output for most listed images, plus duplicates and orphans
+    listed = pd.Series(np.concatenate([left, right])).dropna()
+    listed = listed[~listed.duplicated()]
+    names = listed[rng.random(len(listed)) >= missing_image_rate].to_numpy(dtype=object)
+    names = np.concatenate([names, rng.choice(names, size=int(len(names) * duplicate_rate))]) if len(names) else names
+    n_orphans = int(len(names) * orphan_rate)
+    orphans = _filenames(rng.integers(9_000_000, 9_999_999, size=n_orphans), LEFT_FIELD,
+                         np.zeros(n_orphans, dtype=int), np.full(n_orphans, ".jpg"))
+    names = pd.Series(np.concatenate([names, orphans]), dtype=object)
+    m = len(names)
+    # Cosmetic variation that normalization must undo: extension case/spelling, directories, whitespace
+    stem = names.str.replace(r"\.[a-z0-9]+$", "", regex=True)
+    ext = pd.Series(rng.choice([".jpg", ".JPG", ".png", ".jpeg"], size=m, p=[0.7, 0.1, 0.15, 0.05]))
+    ext = ext.where(~names.str.endswith(".png"), ".png")
+    prefix = pd.Series(rng.choice(["images/", "M:\\AUTOMORPH\\Results\\M1\\", " "], size=m))
+    prefix = prefix.where(rng.random(m) < path_prefix_rate, "")
+    vessel = pd.DataFrame({"original_filename": (prefix + stem + ext).to_numpy(dtype=object)})
+    feats = rng.normal(size=(m, n_features)).astype("float32")
+    feats[rng.random((m, n_features)) < 0.002] = np.nan
+    vessel = pd.concat([vessel, pd.DataFrame(feats, columns=feature_names(n_features))], axis=1)
+    order = rng.permutation(m)
+    return vessel.iloc[order].reset_index(drop=True), pat
+
+
+def write_cohort(out_dir, n_images, n_features=12, seed=0, block_participants=250_000, **rates):
+    """Write a cohort of roughly `n_images` vessel rows to out_dir in participant blocks.
+
+    Returns (vessel_fp, pat_fp, n_vessel_rows, n_participants).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    vessel_fp = os.path.join(out_dir, "vessel_features_merged.csv")
+    pat_fp = os.path.join(out_dir, "retina_ckd_survival_ready_PAIRED.csv")
+    n_participants = max(1, int(round(n_images / IMAGES_PER_PARTICIPANT)))
+    n_rows = 0
+    for i, start in enumerate(range(0, n_participants, block_participants)):
+        size = min(block_participants, n_participants - start)
+        vessel, pat = make_cohort(size, n_features, seed=seed + i, start_eid=START_EID + start, **rates)
+        mode, header = ("w", True) if i == 0 else ("a", False)
+        vessel.to_csv(vessel_fp, index=False, mode=mode, header=header, float_format="%.6g")
+        pat.to_csv(pat_fp, index=False, mode=mode, header=header)
+        n_rows += len(vessel)
+    return vessel_fp, pat_fp, n_rows, n_participants
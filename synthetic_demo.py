@@ -1,73 +1,39 @@
 """
 Synthetic demo for AUTOMORPH preprocessing
-- Writes tiny synthetic `vessel_features_merged.csv` and `retina_ckd_survival_ready_PAIRED.csv` into the AUTMORPH folder
-- Runs the main script `Creating new image and participant level QC.py` using the same Python interpreter
+- Builds a tiny synthetic vessel feature table and participant table (synthetic_data.demo_cohort)
+- Runs the QC pipeline on them in-process (pipeline.run_qc_pipeline), no files needed
 - Prints small samples of the outputs for quick verification
+- --output-dir also writes the synthetic inputs and the master tables there (e.g. to try the other scripts)
 """
+import argparse
 import os
-import pandas as pd
-import subprocess
-import sys
 
-ROOT = r"M:/NEW-PROJECT/AUTOMORPH"
-os.makedirs(ROOT, exist_ok=True)
+from pipeline import run_qc_pipeline
+from synthetic_data import demo_cohort
+
+ap = argparse.ArgumentParser(description="Run the QC pipeline on a tiny synthetic cohort.")
+ap.add_argument("--output-dir", default=None, help="also write inputs and outputs to this folder")
+args = ap.parse_args()
 
 # Create synthetic participant table (6 participants with mixed left/right availability)
-pat = pd.DataFrame({
-    'eid': [1001,1002,1003,1004,1005,1006],
-    'left_image_filename': ['1001_21015_0_0.jpg','1002_21015_0_0.jpg', pd.NA, '1004_21015_0_0.jpg','1005_21015_0_0.jpg', pd.NA],
-    'right_image_filename': [pd.NA, '1002_21016_0_0.jpg','1003_21016_0_0.jpg','1004_21016_0_0.jpg', pd.NA, '1006_21016_0_0.jpg']
-})
-pat_fp = os.path.join(ROOT, 'retina_ckd_survival_ready_PAIRED.csv')
-pat.to_csv(pat_fp, index=False)
+# and vessel features for 8 of their images (see synthetic_data.demo_cohort)
+vessel, pat = demo_cohort()
 
-# Create synthetic vessel features for some image files
-vessel_rows = []
-# image for 1001 left
-vessel_rows.append({'original_filename':'1001_21015_0_0.jpg', 'height':100, 'width':120, 'area_px':1200, 'vessel_density':0.32})
-# 1002 left and right
-vessel_rows.append({'original_filename':'1002_21015_0_0.jpg', 'height':98, 'width':118, 'area_px':1156, 'vessel_density':0.30})
-vessel_rows.append({'original_filename':'1002_21016_0_0.jpg', 'height':101, 'width':119, 'area_px':1201, 'vessel_density':0.33})
-# 1003 only right
-vessel_rows.append({'original_filename':'1003_21016_0_0.jpg', 'height':95, 'width':110, 'area_px':1045, 'vessel_density':0.28})
-# 1004 both
-vessel_rows.append({'original_filename':'1004_21015_0_0.jpg', 'height':102, 'width':125, 'area_px':1275, 'vessel_density':0.35})
-vessel_rows.append({'original_filename':'1004_21016_0_0.jpg', 'height':103, 'width':126, 'area_px':1298, 'vessel_density':0.36})
-# 1005 left only
-vessel_rows.append({'original_filename':'1005_21015_0_0.jpg', 'height':99, 'width':115, 'area_px':1138, 'vessel_density':0.31})
-# 1006 right only
-vessel_rows.append({'original_filename':'1006_21016_0_0.jpg', 'height':100, 'width':120, 'area_px':1200, 'vessel_density':0.29})
+if args.output_dir:
+    os.makedirs(args.output_dir, exist_ok=True)
+    pat.to_csv(os.path.join(args.output_dir, 'retina_ckd_survival_ready_PAIRED.csv'), index=False)
+    vessel.to_csv(os.path.join(args.output_dir, 'vessel_features_merged.csv'), index=False)
 
-vessel = pd.DataFrame(vessel_rows)
-vessel_fp = os.path.join(ROOT, 'vessel_features_merged.csv')
-vessel.to_csv(vessel_fp, index=False)
+# Run the preprocessing pipeline in memory (outputs written only with --output-dir)
+out = run_qc_pipeline(vessel, pat, output_dir=args.output_dir)
 
-print('Wrote synthetic files:')
-print('  ', pat_fp)
-print('  ', vessel_fp)
+print('QC:', out['qc'])
 
-# Run the main preprocessing script using the current Python interpreter (or adjust path)
-main_script = os.path.join(ROOT, 'Creating new image and participant level QC.py')
-print('\nRunning preprocessing script...')
-cmd = [sys.executable, main_script]
-proc = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True)
-print('Return code:', proc.returncode)
-print('Stdout:\n', proc.stdout)
-print('Stderr:\n', proc.stderr)
+print('\nAggregated sample:')
+print(out['aggregated'].head(10).to_string(index=False))
 
-# Show generated outputs (aggregated file)
-agg_fp = os.path.join(ROOT, 'master_participant_level_single_image_aggregated.csv')
-if os.path.exists(agg_fp):
-    df = pd.read_csv(agg_fp)
-    print('\nAggregated file sample:')
-    print(df.head(10).to_string(index=False))
-else:
-    print('\nAggregated file not found:', agg_fp)
+print('\nEye used:')
+print(out['eye_used'].to_string(index=False))
 
-# Eye used file
-eye_fp = os.path.join(ROOT, 'master_participant_eye_used.csv')
-if os.path.exists(eye_fp):
-    print('\nEye used:')
-    print(pd.read_csv(eye_fp).to_string(index=False))
-else:
-    print('\nEye-used file not found:', eye_fp)
+for name, paths in out['saved'].items():
+    print('Saved:', name, paths)
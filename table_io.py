@@ -0,0 +1,289 @@
+"""
+Reading and writing the master tables as CSV, Parquet or Feather
+
+Columnar outputs (Parquet/Feather, need pyarrow) are what downstream jobs should re-read: they keep
+dtypes, are much smaller and let readers load only the columns and eye partitions they need.
+
+Layout in the output directory:
+- CSV:                 <name>.csv (unchanged)
+- columnar:            <name>.parquet / <name>.feather
+- columnar, by eye:    <name>.parquet/eye_used=left.parquet, eye_used=right.parquet, ...
+                       one file per eye_used value (missing -> eye_used=__missing__); every file holds all
+                       columns plus __row__, the original row position, so full reads keep CSV row order
+
+CSV outputs can be compressed while they are written: <name>.csv.gz (gzip) or <name>.csv.zst (zstd,
+needs the zstandard package). Every file or partition directory is first written under a .tmp name
+and then renamed, so a crashed or interrupted run never leaves a partial table behind. write_tables
+writes several tables from a thread pool.
+
+read_table prefers Parquet, then Feather, then CSV (plain, .gz, .zst), so readers transparently pick
+up whatever exists. Writing a table removes its copies in the formats and CSV compressions that were
+not written, so a copy from an earlier run with other --formats is never read instead of the new one.
+"""
+import glob
+import io
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+IMAGE_TABLE = "master_image_level"
+PARTICIPANT_TABLE = "master_participant_level_single_image"
+AGGREGATED_TABLE = "master_participant_level_single_image_aggregated"
+EYE_USED_TABLE = "master_participant_eye_used"
+LEFT_ONLY_TABLE = "master_participant_level_left_only"
+LEFT_ONLY_AGGREGATED_TABLE = "master_participant_level_left_only_aggregated"
+RIGHT_ONLY_TABLE = "master_participant_level_right_only"
+RIGHT_ONLY_AGGREGATED_TABLE = "master_participant_level_right_only_aggregated"
+BOTH_EYES_TABLE = "master_participant_level_both_eyes"
+
+FORMATS = ("csv", "parquet", "feather")
+COLUMNAR_FORMATS = ("parquet", "feather")
+PARTITION_COL = "eye_used"
+MISSING_PARTITION = "__missing__"
+ROW_COL = "__row__"
+COMPRESSIONS = ("gzip", "zstd")
+CSV_EXTENSIONS = {None: "csv", "gzip": "csv.gz", "zstd": "csv.zst"}
+GZIP_LEVEL = 6
+DEFAULT_IO_THREADS = 4
+
+
+def _require_pyarrow(fmt):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError as e:
+        raise ImportError(f"writing/reading {fmt} tables requires pyarrow (pip install pyarrow)") from e
+
+
+def _write_file(df, path, fmt):
+    if fmt == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(path)
+
+
+def _read_file(path, fmt, columns):
+    if fmt == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_feather(path, columns=columns)
+
+
+def _require_zstandard():
+    try:
+        import zstandard  # noqa: F401
+    except ImportError as e:
+        raise ImportError("zstd compression requires zstandard (pip install zstandard)") from e
+
+
+def csv_compression(compression):
+    """pandas to_csv `compression` argument (gzip without a timestamp, so reruns give identical bytes)."""
+    if compression is None:
+        return None
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression!r}; expected one of {COMPRESSIONS}")
+    if compression == "zstd":
+        _require_zstandard()
+        return {"method": "zstd"}
+    return {"method": "gzip", "mtime": 0, "compresslevel": GZIP_LEVEL}
+
+
+def table_path(out_dir, name, fmt, compression=None):
+    """Path of a table; `compression` only applies to CSV."""
+    return os.path.join(out_dir, f"{name}.{CSV_EXTENSIONS[compression] if fmt == 'csv' else fmt}")
+
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(f) for f in glob.glob(os.path.join(path, "*")))
+    return os.path.getsize(path)
+
+
+@contextmanager
+def atomic_output(path):
+    """Yield a temporary path next to `path`; on success it replaces `path` (file or directory), on error
+    it is removed and `path` is left as it was."""
+    tmp = f"{path}.tmp"
+    for stale in (tmp, f"{path}.old"):
+        if os.path.isdir(stale):
+            shutil.rmtree(stale)
+        elif os.path.exists(stale):
+            os.remove(stale)
+    try:
+        yield tmp
+    except BaseException:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if os.path.isdir(tmp) or os.path.isdir(path):
+        # Directories cannot be replaced in one step: move the old one aside first
+        if os.path.exists(path):
+            os.replace(path, f"{path}.old")
+        os.replace(tmp, path)
+        if os.path.isdir(f"{path}.old"):
+            shutil.rmtree(f"{path}.old")
+        elif os.path.exists(f"{path}.old"):
+            os.remove(f"{path}.old")
+    else:
+        os.replace(tmp, path)
+
+
+def remove_stale_copies(out_dir, name, formats, compression=None):
+    """Remove copies of a table in formats not in `formats` and CSVs in other compressions (left over from
+    earlier runs, they would shadow or outlive the fresh table in find_table)."""
+    keep = {table_path(out_dir, name, fmt, compression) for fmt in formats}
+    for fmt, other in [(fmt, None) for fmt in COLUMNAR_FORMATS] + [("csv", c) for c in CSV_EXTENSIONS]:
+        stale = table_path(out_dir, name, fmt, other)
+        if stale in keep:
+            continue
+        if os.path.isdir(stale):
+            shutil.rmtree(stale)
+        elif os.path.exists(stale):
+            os.remove(stale)
+
+
+def _splice_csv(df, path, reuse, out_path=None):
+    """Rewrite the CSV at `path` (to `out_path`, default `path`) for df, copying the lines of rows with
+    reuse >= 0 from the existing file.
+
+    Only rows with reuse == -1 are formatted. Returns False (nothing written) if the existing file
+    does not fit: missing, another header, or fewer rows than referenced.
+    """
+    reuse = np.asarray(reuse, dtype="int64")
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as fh:
+        old_lines = fh.readlines()
+    fresh = np.flatnonzero(reuse < 0)
+    rendered = io.BytesIO(df.iloc[fresh].to_csv(index=False).encode("utf-8")).readlines()
+    if len(rendered) != len(fresh) + 1 or old_lines[:1] != rendered[:1] or len(old_lines) < reuse.max(initial=-1) + 2:
+        return False  # also catches quoted values spanning lines
+    lines = np.empty(len(df), dtype=object)
+    lines[reuse >= 0] = np.asarray(old_lines, dtype=object)[reuse[reuse >= 0] + 1]
+    lines[fresh] = rendered[1:]
+    with open(out_path or path, "wb") as fh:
+        fh.write(rendered[0])
+        fh.writelines(lines)
+    return True
+
+
+def write_table(df, out_dir, name, formats=("csv",), partition=None, reuse=None, compression=None, log=None):
+    """Write `df` as <name>.<fmt> for every format in `formats`.
+
+    `partition` is an optional eye_used Series aligned to df; columnar formats are then split into
+    one file per value (the column is added to the columnar files if df lacks it). CSV output is
+    always exactly `df`, compressed with `compression` ('gzip'/'zstd') if given. `reuse` optionally
+    gives, per row, the row of the existing uncompressed CSV holding the identical line (-1 = format
+    the row); that CSV is then patched instead of re-formatted (see incremental.py). If `log` is a
+    list, a {table, format, path, bytes, seconds} dict is appended per file written. Returns
+    {format: path}.
+    """
+    paths = {}
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown table format {fmt!r}; expected one of {FORMATS}")
+        start = time.perf_counter()
+        path = table_path(out_dir, name, fmt, compression)
+        paths[fmt] = path
+        if fmt == "csv":
+            with atomic_output(path) as tmp:
+                if compression is not None or reuse is None or not _splice_csv(df, path, reuse, tmp):
+                    df.to_csv(tmp, index=False, compression=csv_compression(compression))
+        else:
+            _require_pyarrow(fmt)
+            with atomic_output(path) as tmp:
+                if partition is None:
+                    _write_file(df, tmp, fmt)
+                else:
+                    os.makedirs(tmp)
+                    data = df.assign(**{PARTITION_COL: partition.to_numpy(dtype=object), ROW_COL: range(len(df))})
+                    keys = pd.Series(data[PARTITION_COL]).fillna(MISSING_PARTITION).astype(str)
+                    for value, part in data.groupby(keys.to_numpy(), sort=True):
+                        _write_file(part, os.path.join(tmp, f"{PARTITION_COL}={value}.{fmt}"), fmt)
+        if log is not None:
+            log.append({"table": name, "format": fmt, "path": path, "bytes": _size(path),
+                        "seconds": round(time.perf_counter() - start, 3)})
+    remove_stale_copies(out_dir, name, formats, compression)
+    return paths
+
+
+def write_tables(jobs, threads=DEFAULT_IO_THREADS, log=None):
+    """Run write_table(**job) for every job dict on a pool of `threads` threads.
+
+    Returns {table name: {format: path}}; `log` as in write_table.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = {job["name"]: pool.submit(write_table, **job, log=log) for job in jobs}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def format_write_log(log):
+    """One line per written file: path, size and write time."""
+    return [f"  {e['path']}: {e['bytes'] / 1e6:.1f} MB in {e['seconds']:.2f}s" for e in log]
+
+
+def find_table(out_dir, name):
+    """(format, path) of the preferred existing copy of a table, or raise FileNotFoundError."""
+    for fmt, compression in [(fmt, None) for fmt in COLUMNAR_FORMATS] + [("csv", c) for c in CSV_EXTENSIONS]:
+        path = table_path(out_dir, name, fmt, compression)
+        if os.path.exists(path):
+            return fmt, path
+    raise FileNotFoundError(f"no {name}.{{parquet,feather,csv,csv.gz,csv.zst}} in {out_dir}")
+
+
+def _partition_values(eye_used):
+    if eye_used is None:
+        return None
+    values = [eye_used] if isinstance(eye_used, str) or eye_used is pd.NA else list(eye_used)
+    return {MISSING_PARTITION if v is None or v is pd.NA else v for v in values}
+
+
+def read_table(out_dir, name, columns=None, eye_used=None):
+    """Read a master table, optionally only some `columns` and only rows whose eye_used is in `eye_used`.
+
+    `eye_used` is a value or list of values ('left', 'right', 'both', None). Partitioned columnar
+    tables only open the matching partition files. CSV tables without an eye_used column take it
+    from master_participant_eye_used (joined on eid) when filtering.
+    """
+    fmt, path = find_table(out_dir, name)
+    wanted = _partition_values(eye_used)
+
+    if fmt == "csv":
+        header = list(pd.read_csv(path, nrows=0).columns)
+        join_eyes = PARTITION_COL not in header and (wanted is not None or PARTITION_COL in (columns or ()))
+        usecols = None
+        if columns is not None:
+            extra = ["eid"] if join_eyes else [PARTITION_COL] * (wanted is not None)
+            usecols = [c for c in dict.fromkeys(list(columns) + extra) if c in header]
+        df = pd.read_csv(path, usecols=usecols, low_memory=False)
+        if join_eyes:
+            df = df.merge(read_table(out_dir, EYE_USED_TABLE, columns=["eid", PARTITION_COL]), on="eid", how="left")
+        if wanted is not None:
+            df = df[df[PARTITION_COL].fillna(MISSING_PARTITION).isin(wanted)].reset_index(drop=True)
+        return df if columns is None else df[list(columns)]
+
+    _require_pyarrow(fmt)
+    if os.path.isfile(path):
+        filter_col = [PARTITION_COL] if wanted is not None and columns is not None and PARTITION_COL not in columns else []
+        df = _read_file(path, fmt, None if columns is None else list(columns) + filter_col)
+        if wanted is not None:
+            df = df[df[PARTITION_COL].fillna(MISSING_PARTITION).isin(wanted)].reset_index(drop=True)
+        return df if columns is None else df[list(columns)]
+
+    files = sorted(glob.glob(os.path.join(path, f"{PARTITION_COL}=*.{fmt}")))
+    read_cols = None if columns is None else list(dict.fromkeys(list(columns) + [ROW_COL]))
+    parts = []
+    for part_fp in files:
+        value = os.path.basename(part_fp)[len(PARTITION_COL) + 1:-len(fmt) - 1]
+        if wanted is None or value in wanted:
+            parts.append(_read_file(part_fp, fmt, read_cols))
+    if not parts:
+        # No matching partition: empty frame with the table's columns
+        parts = [_read_file(files[0], fmt, read_cols).iloc[:0]] if files else [pd.DataFrame(columns=read_cols or [ROW_COL])]
+    df = pd.concat(parts, ignore_index=True)
+    return df.sort_values(ROW_COL, kind="stable").drop(columns=ROW_COL).reset_index(drop=True)
@@ -0,0 +1,151 @@
+"""
+Single-pass integrity check of the filename -> eid mapping inputs
+
+Reads vessel_features_merged.csv and retina_ckd_survival_ready_PAIRED.csv once, normalizes every
+filename with the same rules as the QC script (fname_norm.py, eid_index.py) and reports, with
+vectorized operations only:
+
+    ambiguous_stems          filename stems listed for several eids (the QC script leaves these
+                             images unmatched); with the number of image rows dropped
+    multi_assigned_images    normalized filenames listed for several eids, or for both eyes of one eid
+    extension_collisions     image rows whose stem is shared by differently named files (x.jpg / x.png),
+                             so several images compete for the same participant eye
+    duplicate_vessel_rows    repeated filenames in the vessel table; identical = same feature values
+                             as the first occurrence
+    left_right_same_stem     participants whose left and right filenames have the same stem;
+                             same_file = identical normalized name
+
+One compact CSV per issue (header only when clean) and integrity_summary.json with the counts and
+the mapping-status breakdown are written to --out-dir.
+
+Usage: python validate_integrity.py --out-dir M:/NEW-PROJECT/AUTOMORPH/integrity [--strict]
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from eid_index import load_eid_index
+from incremental import row_hashes
+from qc_pipeline import mapping_status_counts, normalize_participants, resolve_images
+
+VESSEL_FP = "M:/NEW-PROJECT/AUTOMORPH/vessel_features_merged.csv"
+PAT_FP = "M:/NEW-PROJECT/AUTOMORPH/retina_ckd_survival_ready_PAIRED.csv"
+OUTPUT_DIR = r"M:/NEW-PROJECT/AUTOMORPH/integrity"
+SUMMARY_NAME = "integrity_summary.json"
+ISSUES = ("ambiguous_stems", "multi_assigned_images", "extension_collisions", "duplicate_vessel_rows",
+          "left_right_same_stem")
+
+
+def _joined(values, keys):
+    """';'-joined sorted distinct values per key (only called on the few keys with an issue)."""
+    df = pd.DataFrame({"key": keys, "v": values.astype(str)}).drop_duplicates()
+    return df.sort_values("v").groupby("key", sort=False)["v"].agg(";".join)
+
+
+def key_issues(eid_index, key_type, stem_rows=None):
+    """Index keys of `key_type` listed for several eids or (for 'norm') for both eyes of one eid."""
+    sel = eid_index.loc[eid_index["key_type"] == key_type, ["key", "eid", "eye", "n_eids"]]
+    g = sel.groupby("key", observed=True).agg(n_eids=("n_eids", "first"), n_eyes=("eye", "nunique"))
+    flagged = g["n_eids"] > 1
+    if key_type == "norm":
+        flagged |= g["n_eyes"] > 1
+    g = g[flagged]
+    rows = sel[sel["key"].isin(g.index)]
+    out = pd.DataFrame({key_type if key_type == "stem" else "filename": g.index,
+                        "n_eids": g["n_eids"].to_numpy(),
+                        "eids": _joined(rows["eid"], rows["key"]).reindex(g.index).to_numpy(),
+                        "eyes": _joined(rows["eye"], rows["key"]).reindex(g.index).to_numpy()})
+    if stem_rows is not None:
+        out["n_vessel_rows"] = stem_rows.reindex(g.index, fill_value=0).to_numpy()
+    return out
+
+
+def extension_collisions(images):
+    """Image rows whose stem is shared by more than one distinct normalized filename."""
+    n_names = images.groupby("orig_fname_stem")["orig_fname_norm"].transform("nunique")
+    sel = images.loc[(n_names > 1).to_numpy(), ["original_filename", "orig_fname_stem", "eid", "matched_eye"]]
+    sel = sel.rename(columns={"orig_fname_stem": "stem"}).rename_axis("row").reset_index()
+    return sel.sort_values(["stem", "row"], kind="stable").reset_index(drop=True)
+
+
+def duplicate_rows(vessel, images):
+    """Rows repeating an earlier normalized filename, with that first row and whether the values match."""
+    names = images["orig_fname_norm"]
+    dup = names.duplicated(keep=False).to_numpy() & names.notna().to_numpy()
+    if not dup.any():
+        return pd.DataFrame(columns=["row", "original_filename", "first_row", "identical"])
+    rows = np.flatnonzero(dup)
+    hashes = row_hashes(vessel.iloc[rows].drop(columns="original_filename"))
+    sub = pd.DataFrame({"row": rows, "name": names.to_numpy()[rows], "h": hashes})
+    first = sub.groupby("name", sort=False)[["row", "h"]].transform("first")
+    sub = sub.assign(first_row=first["row"], identical=sub["h"] == first["h"])[sub["row"] != first["row"]]
+    return pd.DataFrame({"row": sub["row"].to_numpy(), "original_filename": vessel["original_filename"].to_numpy()[sub["row"]],
+                         "first_row": sub["first_row"].to_numpy(), "identical": sub["identical"].to_numpy()})
+
+
+def left_right_same_stem(pat):
+    """Participants whose left and right filenames share a stem (normalized participant table)."""
+    same = (pat["left_fname_stem"] == pat["right_fname_stem"]).fillna(False).to_numpy(dtype=bool)
+    sel = pat.loc[same, ["eid", "left_fname_norm", "right_fname_norm"]]
+    return sel.assign(same_file=(sel["left_fname_norm"] == sel["right_fname_norm"]).fillna(False)).reset_index(drop=True)
+
+
+def find_issues(vessel, pat, eid_index):
+    """All integrity issues as {issue: DataFrame} plus the mapping-status counts of the image rows.
+
+    `vessel` is the raw image table and `pat` the participant table (gains normalized name columns).
+    """
+    images = resolve_images(vessel[["original_filename"]].copy(), eid_index)
+    normalize_participants(pat)
+    stem_rows = images["orig_fname_stem"].value_counts()
+    issues = {
+        "ambiguous_stems": key_issues(eid_index, "stem", stem_rows),
+        "multi_assigned_images": key_issues(eid_index, "norm"),
+        "extension_collisions": extension_collisions(images),
+        "duplicate_vessel_rows": duplicate_rows(vessel, images),
+        "left_right_same_stem": left_right_same_stem(pat),
+    }
+    return issues, mapping_status_counts(images)
+
+
+def write_issues(issues, status_counts, out_dir):
+    """One CSV per issue and the JSON summary in out_dir; returns the summary dict."""
+    os.makedirs(out_dir, exist_ok=True)
+    for name in ISSUES:
+        issues[name].to_csv(os.path.join(out_dir, f"{name}.csv"), index=False)
+    summary = {name: len(issues[name]) for name in ISSUES}
+    summary["n_vessel_rows_in_ambiguous_stems"] = int(issues["ambiguous_stems"]["n_vessel_rows"].sum())
+    summary["n_duplicate_rows_with_different_values"] = int((~issues["duplicate_vessel_rows"]["identical"].astype(bool)).sum())
+    summary["mapping_status"] = status_counts
+    with open(os.path.join(out_dir, SUMMARY_NAME), "w") as fh:
+        json.dump(summary, fh, indent=2)
+    return summary
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--vessel", default=VESSEL_FP, help="image-level feature table (vessel_features_merged.csv)")
+    ap.add_argument("--pat", default=PAT_FP, help="participant CSV with left/right_image_filename")
+    ap.add_argument("--out-dir", default=OUTPUT_DIR)
+    ap.add_argument("--strict", action="store_true", help="exit with status 1 if any issue is found")
+    args = ap.parse_args()
+
+    vessel = pd.read_csv(args.vessel, low_memory=False)
+    pat = pd.read_csv(args.pat, low_memory=False, usecols=["eid", "left_image_filename", "right_image_filename"])
+    issues, status_counts = find_issues(vessel, pat, load_eid_index(args.pat))
+    summary = write_issues(issues, status_counts, args.out_dir)
+
+    for name in ISSUES:
+        print(f"{name}: {summary[name]}")
+    print(f"mapping_status: {summary['mapping_status']}")
+    print(f"Saved: {args.out_dir}")
+    if args.strict and any(summary[name] for name in ISSUES):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,25 @@
-import pandas as pd
+from eid_index import load_eid_index, participant_stems
+from table_io import PARTICIPANT_TABLE, read_table
 
 # Paths (same as used by your script)
-participant_csv = "M:/NEW-PROJECT/AUTOMORPH/master_participant_level_left_right.csv"
+OUTPUT_DIR = "M:/NEW-PROJECT/AUTOMORPH"
 pat_csv = "M:/NEW-PROJECT/AUTOMORPH/retina_ckd_survival_ready_PAIRED.csv"
 
-# Load participant-level output
-p = pd.read_csv(participant_csv, low_memory=False)
+# Load only the participant-level columns needed here (Parquet/Feather outputs are used when present)
+p = read_table(OUTPUT_DIR, PARTICIPANT_TABLE, columns=['eid', 'num_images_with_features'])
 
-# Try to use left/right stem columns from participant; if missing, load original pat to get stems
-if 'left_fname_stem' not in p.columns or 'right_fname_stem' not in p.columns:
-    pat = pd.read_csv(pat_csv, low_memory=False)
-    pat['left_fname_norm'] = pat['left_image_filename'].astype(str).str.strip().map(lambda x: x.split('/')[-1].lower())
-    pat['left_fname_stem'] = pat['left_fname_norm'].str.replace(r'\.[a-z0-9]+$', '', regex=True)
-    pat['right_fname_norm'] = pat['right_image_filename'].astype(str).str.strip().map(lambda x: x.split('/')[-1].lower())
-    pat['right_fname_stem'] = pat['right_fname_norm'].str.replace(r'\.[a-z0-9]+$', '', regex=True)
-    # Join stems into participant table
-    p = p.merge(pat[['eid','left_fname_stem','right_fname_stem']], on='eid', how='left')
+# Left/right stems come from the cached filename -> eid index
+p = p.merge(participant_stems(load_eid_index(pat_csv)), on='eid', how='left')
 
 # Identify participants with two-eye features
-if 'num_images_with_features' in p.columns:
-    both = p[p['num_images_with_features'] == 2].copy()
-else:
-    both = p[p[['has_left_features','has_right_features']].all(axis=1)].copy()
+both = p[p['num_images_with_features'] == 2].copy()
 
 n_both = len(both)
 print(f"Participants with both-eye features (from file): {n_both}")
 
 # Compare stems
-both['stems_equal'] = (both['left_fname_stem'] == both['right_fname_stem'])
+# (a missing stem counts as different)
+both['stems_equal'] = (both['left_fname_stem'] == both['right_fname_stem']).fillna(False).astype(bool)
 
 n_equal = both['stems_equal'].sum()
 n_diff = n_both - n_equal